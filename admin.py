@@ -1,30 +1,148 @@
 """Handlers for admin features"""
 
-from model import Poll
+import csv
+import json
+import hmac
+import urllib
+
+import metrics
+import util
+
+from model import Poll, PollSummary, VoteShard
 
 import webapp2
+from google.appengine.ext import ndb
 from google.appengine.ext.ndb.query import Cursor
+from google.appengine.api import taskqueue
 from google.appengine.api.datastore_errors import BadValueError
 
 class MigratePage(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+
     def get(self):
         self.response.headers['Content-Type'] = 'text/plain'
         self.response.write('Migrate page\n')
 
+        try:
+            cursor = Cursor.from_websafe_string(self.request.get('cursor'))
+        except BadValueError:
+            cursor = None
+
+        query = Poll.query()
+        polls, next_cursor, has_more = query.fetch_page(self.BATCH_SIZE, start_cursor=cursor)
+
+        legacy_ids = [poll.key.id() for poll in polls if poll.has_legacy_options()]
+        migrate_futures = [self.migrate_async(poll_id) for poll_id in legacy_ids]
+        # also backfills the summaries of polls last saved before summaries existed
+        summaries = [PollSummary.from_poll(poll) for poll in polls
+                     if poll.active and not poll.has_legacy_options()]
+        summary_futures = ndb.put_multi_async(summaries)
+        ndb.Future.wait_all(migrate_futures + summary_futures)
+        for future in summary_futures:
+            future.check_success()
+        migrated = sum(1 for future in migrate_futures if future.get_result())
+        self.response.write('Migrated {} of {} polls\n'.format(migrated, len(polls)))
+
+        # polls from before ballots get one for each respondent, once their options are migrated
+        ballot_futures = [Poll.complete_ballots_async(poll.key.id()) for poll in polls
+                          if not poll.ballots_complete]
+        completed = sum(1 for future in ballot_futures if future.get_result())
+        self.response.write('Completed the ballots of {} polls\n'.format(completed))
+
+        if not has_more:
+            self.response.write('Done\n')
+            return
+
+        params = {'cursor': next_cursor.to_websafe_string()}
+        taskqueue.add(url='/migrate', method='GET', params=params)
+        self.response.write('Next batch queued\n')
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def migrate_async(poll_id):
+        poll = yield Poll.get_by_id_async(poll_id)
+        if not poll or not poll.has_legacy_options():
+            raise ndb.Return(False)
+        yield poll.save_async()
+        raise ndb.Return(True)
+
+class MetricsPage(webapp2.RequestHandler):
+    WINDOWS = [5, 60]
+
+    def get(self):
+        try:
+            windows = [int(self.request.get('minutes'))]
+        except ValueError:
+            windows = self.WINDOWS
+
+        for minutes in windows:
+            counters, histograms = metrics.load(minutes)
+            self.response.write('<h3>Last {} minutes</h3>\n'.format(minutes))
+
+            self.response.write('<table><tr><th>Timer</th><th>Count</th><th>p50</th><th>p90</th>'
+                                '<th>p99</th><th>Histogram (ms)</th></tr>\n')
+            for name, histogram in sorted(histograms.items()):
+                percentiles = ['&le;{}ms'.format(metrics.estimate_percentile(histogram, fraction))
+                               for fraction in [0.5, 0.9, 0.99]]
+                buckets = ['{}:{}'.format(bound, count) for bound, count
+                           in zip(metrics.BUCKETS + ['more'], histogram) if count]
+                cells = [name, sum(histogram)] + percentiles + [' '.join(buckets)]
+                self.response.write('<tr>' + ''.join('<td>{}</td>'.format(cell) for cell in cells)
+                                    + '</tr>\n')
+            self.response.write('</table>\n')
+
+            self.response.write('<table><tr><th>Counter</th><th>Count</th></tr>\n')
+            for name, count in sorted(counters.items()):
+                self.response.write('<tr><td>{}</td><td>{}</td></tr>\n'.format(name, count))
+            self.response.write('</table>\n')
+
 class PollPage(webapp2.RequestHandler):
     def get(self, pid):
         try:
             pid = int(pid)
-            poll = Poll.get_by_id(pid)
-            if not poll:
+            page = int(self.request.get('page') or 0)
+            start = page * Poll.WEB_PAGE_SIZE
+            poll = Poll.get_live(pid, start, start + Poll.WEB_PAGE_SIZE)
+            if not poll or not 0 <= page < poll.get_num_pages():
                 raise ValueError
         except ValueError:
             self.response.set_status(404)
             self.response.write('Invalid poll ID')
             return
-        self.response.write(poll.render_html())
+        self.response.write(self.render_poll(poll, page))
+
+        links = []
+        if page > 0:
+            links.append('<a href="{}">Previous</a>'.format(self.get_page_url(page - 1)))
+        if page + 1 < poll.get_num_pages():
+            links.append('<a href="{}">Next</a>'.format(self.get_page_url(page + 1)))
+        if links:
+            self.response.write('<p>{}</p>'.format(' | '.join(links)))
+
+    def get_page_url(self, page):
+        params = dict(self.request.GET.items(), page=page)
+        return self.request.path + '?' + urllib.urlencode(params)
+
+    @staticmethod
+    def render_poll(poll, page):
+        return poll.render_html(page=page)
+
+class SignedPollPage(PollPage):
+    # the full list linked from polls too long for Telegram; the signature stands in for a login
+    def get(self, pid):
+        if not hmac.compare_digest(str(Poll.sign(pid)), str(self.request.get('sig'))):
+            self.response.set_status(404)
+            self.response.write('Invalid poll ID')
+            return
+        super(SignedPollPage, self).get(pid)
+
+    @staticmethod
+    def render_poll(poll, page):
+        return poll.render_public_html(page)
 
 class PollsPage(webapp2.RequestHandler):
+    BATCH_SIZE = 20
+
     def get(self):
         try:
             cursor = Cursor.from_websafe_string(self.request.get('cursor'))
@@ -38,14 +156,163 @@ class PollsPage(webapp2.RequestHandler):
         except (TypeError, ValueError):
             limit = 100
 
-        query = Poll.query().order(-Poll.created)
-        polls, next_cursor, has_more = query.fetch_page(limit, start_cursor=cursor)
+        # summary mode reads poll summaries, so options and respondents are never loaded
+        summary = bool(self.request.get('summary'))
+        model = PollSummary if summary else Poll
 
-        for poll in polls:
-            self.response.write(poll.render_html() + '\n\n<hr>\n\n')
+        query = model.query().order(-model.created)
+        fetch_batch = lambda cursor, remaining: query.fetch_page_async(
+            min(self.BATCH_SIZE, remaining), start_cursor=cursor)
+
+        remaining = limit
+        batch_future = fetch_batch(cursor, remaining)
+        while batch_future is not None:
+            polls, cursor, has_more = batch_future.get_result()
+            remaining -= len(polls)
+            # the next batch is fetched while this one is rendered and written out
+            batch_future = fetch_batch(cursor, remaining) if has_more and remaining > 0 else None
+
+            creators = Poll.get_creators(polls)
+            if not summary:
+                # each poll shows its first WEB_PAGE_SIZE names per option
+                Poll.load_pages(polls, stop=Poll.WEB_PAGE_SIZE)
+                for poll in polls:
+                    if not poll.active:
+                        poll.unpack_archive()
+            for poll in polls:
+                if summary:
+                    self.response.write(poll.render_html_summary(creators) + '\n')
+                else:
+                    self.response.write(poll.render_html(creators) + '\n\n<hr>\n\n')
 
         if not has_more:
             return
 
-        more_url = '?cursor={}&limit={}'.format(next_cursor.to_websafe_string(), limit)
+        more_url = '?cursor={}&limit={}'.format(cursor.to_websafe_string(), limit)
+        if summary:
+            more_url += '&summary=1'
         self.response.write('<p><a href="{}">More</a></p>'.format(more_url))
+
+class ExportPage(webapp2.RequestHandler):
+    # App Engine buffers the whole response, so each request writes at most MAX_ROWS rows; the
+    # X-Next-Cursor and X-Next-Offset headers resume the export at the poll it stopped in, which
+    # can shift by a row or two if that poll gets votes in between
+    PAGE_SIZE = 50
+    MAX_ROWS = 50000
+    FIELDS = ['poll_id', 'admin_uid', 'created', 'poll_title', 'option_index', 'option_title',
+              'uid', 'first_name', 'last_name']
+    CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+
+    def get(self, export_format):
+        if export_format not in self.CONTENT_TYPES:
+            self.response.set_status(404)
+            self.response.write('Invalid export format')
+            return
+        self.response.headers['Content-Type'] = self.CONTENT_TYPES[export_format]
+        write_row = self.get_row_writer(export_format)
+
+        try:
+            offset = max(int(self.request.get('offset') or 0), 0)
+        except ValueError:
+            offset = 0
+
+        if self.request.get('poll'):
+            # read as the whole-kind export reads polls, so an archived poll is not restored
+            try:
+                polls = [poll for poll in [Poll.get_by_id(int(self.request.get('poll')))] if poll]
+            except ValueError:
+                polls = []
+            self.write_rows(write_row, [[(None, poll) for poll in polls]], offset)
+            return
+
+        try:
+            cursor = Cursor.from_websafe_string(self.request.get('cursor'))
+        except BadValueError:
+            cursor = None
+
+        admin_uid = self.request.get('admin_uid')
+        if admin_uid:
+            query = Poll.query(Poll.admin_uid == admin_uid).order(-Poll.created)
+        else:
+            query = Poll.query()
+        self.write_rows(write_row, self.iter_batches(query, cursor), offset)
+
+    def iter_batches(self, query, cursor):
+        # polls in batches of PAGE_SIZE, each with the cursor that resumes the export at it
+        polls = query.iter(start_cursor=cursor, produce_cursors=True, batch_size=self.PAGE_SIZE)
+        batch = []
+        for poll in polls:
+            batch.append((polls.cursor_before(), poll))
+            if len(batch) == self.PAGE_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def write_rows(self, write_row, batches, offset):
+        # offset is the number of rows of the first poll written by the previous request
+        rows = 0
+        for batch in batches:
+            self.load_polls([poll for _, poll in batch], offset, self.MAX_ROWS - rows)
+            for poll_cursor, poll in batch:
+                for row in self.generate_rows(poll, offset):
+                    if rows == self.MAX_ROWS:
+                        if poll_cursor:
+                            self.response.headers['X-Next-Cursor'] = poll_cursor.to_websafe_string()
+                        self.response.headers['X-Next-Offset'] = str(offset)
+                        return
+                    write_row(row)
+                    rows += 1
+                    offset += 1
+                offset = 0
+
+    @staticmethod
+    def load_polls(polls, offset, limit):
+        # votes still waiting in the shards are merged in, and only the pages holding the next
+        # limit rows are read, starting offset rows into the first poll
+        shard_keys = util.flatten([VoteShard.keys_for(poll.key.id()) for poll in polls])
+        shards = ndb.get_multi(shard_keys, use_cache=False)
+        windows = {}
+        for i, poll in enumerate(polls):
+            if not poll.active:
+                poll.unpack_archive()
+            else:
+                poll_shards = shards[i * VoteShard.NUM_SHARDS:(i + 1) * VoteShard.NUM_SHARDS]
+                if VoteShard.has_legacy_votes(poll_shards):
+                    Poll.load_pages([poll])
+                poll.apply_shards(poll_shards)
+            for option in poll.options:
+                num_rows = max(option.count, 1)
+                if offset >= num_rows:
+                    offset -= num_rows
+                    continue
+                if limit > 0:
+                    windows[option] = offset, offset + limit
+                limit -= num_rows - offset
+                offset = 0
+        Poll.attach_pages_async(polls, lambda option: option.get_page_numbers(*windows[option])
+                                if option in windows else []).get_result()
+
+    def get_row_writer(self, export_format):
+        if export_format == 'csv':
+            writer = csv.writer(self.response.out)
+            writer.writerow(self.FIELDS)
+            encode = lambda value: value.encode('utf-8') if isinstance(value, unicode) else value
+            return lambda row: writer.writerow([encode(value) for value in row])
+        return lambda row: self.response.write(json.dumps(dict(zip(self.FIELDS, row))) + '\n')
+
+    @staticmethod
+    def generate_rows(poll, offset=0):
+        # one row per respondent of each option, or one empty row for an option with none
+        poll_fields = [poll.key.id(), poll.admin_uid, poll.created.isoformat(), poll.title]
+        for i, option in enumerate(poll.options):
+            num_rows = max(option.count, 1)
+            if offset >= num_rows:
+                offset -= num_rows
+                continue
+            option_fields = poll_fields + [i, option.title]
+            if not option.count:
+                yield option_fields + [None, None, None]
+            for uid, (first_name, last_name) in option.iter_people(offset):
+                yield option_fields + [uid, first_name, last_name]
+            offset = 0
@@ -2,12 +2,27 @@
 
 import logging
 import json
+import os
+import hashlib
+import time
+import functools
+import threading
+import math
+import warnings
 
+from collections import OrderedDict
+
+import cache
+import metrics
 from secrets import BOT_TOKEN
 
 import webapp2
-import telegram
-from google.appengine.api import taskqueue
+from google.appengine.api import memcache, taskqueue
+
+OUTBOX = 'outbox'
+MAX_TASKS_PER_ADD = 100
+
+_local = threading.local()
 
 class TelegramPage(webapp2.RequestHandler):
     RECOGNISED_ERRORS = ['u\'Bad Request: message is not modified\'',
@@ -17,46 +32,233 @@ class TelegramPage(webapp2.RequestHandler):
                          'Message to edit not found',
                          'Message_id_invalid']
     RECOGNISED_ERROR_URLFETCH = 'urlfetch.Fetch()'
+    MAX_RETRIES = 100  # task_retry_limit of the outbox queue
+
+    POOL_SIZE = 8
+    # None means the real Bot API; the offline dev runner points it at a stub server
+    API_URL = os.environ.get('TELEGRAM_API_URL')
 
-    bot = telegram.Bot(token=BOT_TOKEN)
+    # shared by all requests on the instance so that connections to the Bot API are kept alive
+    bot = None
+    call = None
 
+    @classmethod
+    def get_bot(cls):
+        # telegram is imported on first use, so instances that never call the Bot API skip it
+        if cls.bot is None:
+            import telegram
+            from telegram.utils.request import Request
+            from telegram.vendor.ptb_urllib3.urllib3.contrib.appengine import \
+                AppEnginePlatformWarning
+
+            warnings.simplefilter("ignore", AppEnginePlatformWarning)
+            cls.bot = telegram.Bot(token=BOT_TOKEN, base_url=cls.API_URL,
+                                   request=Request(con_pool_size=cls.POOL_SIZE))
+        return cls.bot
+
+    @metrics.flushed
     def post(self, method_name):
+        import telegram
+
         logging.debug(self.request.body)
 
         kwargs = json.loads(self.request.body)
-        getattr(self.bot, method_name)(**kwargs)
+
+        coalesce_key = self.request.headers.get('X-Coalesce-Key')
+        if coalesce_key:
+            pending = memcache.get(coalesce_key)
+            if pending:
+                method_name, kwargs = pending['method'], pending['kwargs']
+        self.call = method_name, kwargs
+
+        try:
+            with metrics.timer('telegram.' + method_name):
+                getattr(self.get_bot(), method_name)(**kwargs)
+        except telegram.error.RetryAfter as exception:
+            logging.warning(exception)
+            headers = {'X-Coalesce-Key': coalesce_key} if coalesce_key else None
+            defer(exception.retry_after, kwargs)
+            add_tasks([taskqueue.Task(url='/telegram/' + method_name, payload=json.dumps(kwargs),
+                                      countdown=exception.retry_after, headers=headers)])
+            return
 
         logging.info('Success!')
 
     def handle_exception(self, exception, debug):
+        if self.log_exception(exception):
+            return
+        # an edit that fails its last retry never reaches the message, so its fingerprint must not
+        # stop the same edit from being sent later
+        retries = int(self.request.headers.get('X-AppEngine-TaskRetryCount', 0))
+        if self.call and self.call[0] in COALESCED_METHODS and retries >= self.MAX_RETRIES:
+            forget_edit(self.call[1])
+        self.abort(500)
+
+    @classmethod
+    def log_exception(cls, exception):
+        # returns True if the call needs no retry
+        import telegram
+
         if isinstance(exception, telegram.error.NetworkError):
-            if str(exception) in self.RECOGNISED_ERRORS:
+            if str(exception) in cls.RECOGNISED_ERRORS:
                 logging.info(exception)
-                return
+                return True
 
             logging.warning(exception)
 
         elif isinstance(exception, telegram.error.Unauthorized):
             logging.info(exception)
-            return
+            return True
 
         elif isinstance(exception, telegram.error.RetryAfter):
             logging.warning(exception)
 
-        elif self.RECOGNISED_ERROR_URLFETCH in str(exception):
+        elif cls.RECOGNISED_ERROR_URLFETCH in str(exception):
             logging.warning(exception)
 
         else:
             logging.error(exception)
 
-        self.abort(500)
+        return False
+
+class TelegramBatchPage(TelegramPage):
+    MAX_ATTEMPTS = 100
+    RETRY_COUNTDOWN = 5
+
+    @metrics.flushed
+    def post(self):  # pylint: disable=arguments-differ
+        import telegram
+
+        logging.debug(self.request.body)
+
+        results = []
+        retries = []
+        deferred = OrderedDict()
+        for call in json.loads(self.request.body):
+            chat_key = get_chat_key(call['kwargs'])
+            if chat_key in deferred:
+                deferred[chat_key][1].append(call)
+                results.append({'method': call['method'], 'result': 'deferred'})
+                continue
+            try:
+                with metrics.timer('telegram.' + call['method']):
+                    getattr(self.get_bot(), call['method'])(**call['kwargs'])
+                result = 'ok'
+            except telegram.error.RetryAfter as exception:
+                logging.warning(exception)
+                defer(exception.retry_after, call['kwargs'])
+                deferred[chat_key] = (exception.retry_after, [call])
+                result = 'deferred'
+            except Exception as exception:  # pylint: disable=broad-except
+                if self.log_exception(exception):
+                    result = 'ignored'
+                elif call.get('attempt', 1) < self.MAX_ATTEMPTS:
+                    call['attempt'] = call.get('attempt', 1) + 1
+                    retries.append(call)
+                    result = 'retrying'
+                else:
+                    result = 'dropped'
+            results.append({'method': call['method'], 'result': result})
+            metrics.incr('telegram.' + result)
+
+        # only failed calls are retried, so calls that went through are never sent twice
+        tasks = [make_batch_task(calls, retry_after) for retry_after, calls in deferred.values()]
+        if retries:
+            tasks.append(make_batch_task(retries, self.RETRY_COUNTDOWN))
+        add_tasks(tasks)
+
+        logging.info('Batch done: ' + ', '.join(r['method'] + ' ' + r['result'] for r in results))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(results))
+
+class JsonObject(object):
+    # attribute access over a decoded update, standing in for telegram.Update.de_json; missing
+    # fields read as None, as they do on telegram objects
+    __slots__ = ('_data',)
+
+    ALIASES = {'from_user': 'from'}
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getattr__(self, name):
+        value = self._data.get(self.ALIASES.get(name, name))
+        return JsonObject(value) if isinstance(value, dict) else value
 
 def parse_update(payload):
-    return telegram.Update.de_json(json.loads(payload), None)
+    return JsonObject(json.loads(payload))
+
+def batch_api_calls(func):
+    # collects the calls made while func runs and enqueues them with a single taskqueue add; if
+    # func raises, the calls are dropped, since the update is redelivered and would send them again
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _local.batch = {'calls': [], 'tasks': [], 'edits': [], 'markers': []}
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            batch, _local.batch = _local.batch, None
+            discard_batch(batch)
+            raise
+        batch, _local.batch = _local.batch, None
+        flush_batch(batch)
+        return result
+    return wrapper
 
+def make_batch_task(calls, countdown=0):
+    return taskqueue.Task(url='/telegram/batch', payload=json.dumps(calls), countdown=countdown)
+
+def discard_batch(batch):
+    # the dropped edits were recorded as shown and their window as taken, which would make the
+    # redelivered update skip or coalesce them away
+    for kwargs in batch['edits']:
+        forget_edit(kwargs)
+    memcache.delete_multi(batch['markers'])
+
+def flush_batch(batch):
+    calls_by_countdown = OrderedDict()
+    for countdown, call in batch['calls']:
+        calls_by_countdown.setdefault(countdown, []).append(call)
+    tasks = batch['tasks'] + [make_batch_task(calls, countdown) for countdown, calls
+                              in calls_by_countdown.iteritems()]
+    add_tasks(tasks)
+
+@metrics.timed('outbox.add_tasks')
+def add_tasks(tasks):
+    batch = getattr(_local, 'batch', None)
+    if batch is not None:
+        batch['tasks'].extend(tasks)
+        return
+    queue = taskqueue.Queue(OUTBOX)
+    for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[i:i + MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.info('Named task already queued')
+    if tasks:
+        logging.info('{} task(s) queued'.format(len(tasks)))
+
+@metrics.timed('outbox.api_call')
 def api_call(method_name, countdown=0, **kwargs):
+    if method_name in COALESCED_METHODS:
+        if not record_edit(method_name, kwargs):
+            logging.info('Edit skipped, message unchanged: ' + method_name)
+            metrics.incr('outbox.skipped_edits')
+            return
+        batch = getattr(_local, 'batch', None)
+        if batch is not None:
+            batch['edits'].append(kwargs)
+        return coalesce_edit(method_name, countdown, kwargs)
+
+    countdown = schedule(countdown, kwargs)
+    batch = getattr(_local, 'batch', None)
+    if batch is not None:
+        batch['calls'].append((countdown, {'method': method_name, 'kwargs': kwargs}))
+        logging.info('Request batched: ' + method_name)
+        return
+
     payload = json.dumps(kwargs)
-    taskqueue.add(queue_name='outbox', url='/telegram/' + method_name, payload=payload,
+    taskqueue.add(queue_name=OUTBOX, url='/telegram/' + method_name, payload=payload,
                   countdown=countdown)
     countdown_details = ' (countdown {}s)'.format(countdown) if countdown else ''
     logging.info('Request queued: ' + method_name + countdown_details)
@@ -64,3 +266,158 @@ def api_call(method_name, countdown=0, **kwargs):
 
 def send_message(countdown=0, **kwargs):
     return api_call('send_message', countdown=countdown, **kwargs)
+
+COALESCED_METHODS = ('edit_message_text', 'edit_message_reply_markup')
+COALESCE_WINDOW = 1
+COALESCE_TTL = 60
+
+def get_message_key(kwargs):
+    if kwargs.get('inline_message_id'):
+        return 'edit:' + kwargs['inline_message_id']
+    return 'edit:{}:{}'.format(kwargs.get('chat_id'), kwargs.get('message_id'))
+
+def merge_edits(pending, method_name, kwargs):
+    if not pending or method_name == 'edit_message_text' or \
+            pending['method'] == 'edit_message_reply_markup':
+        return {'method': method_name, 'kwargs': kwargs}
+    # a markup-only edit on top of a pending text edit keeps the text and swaps the markup
+    merged_kwargs = pending['kwargs'].copy()
+    merged_kwargs.pop('reply_markup', None)
+    if 'reply_markup' in kwargs:
+        merged_kwargs['reply_markup'] = kwargs['reply_markup']
+    return {'method': pending['method'], 'kwargs': merged_kwargs}
+
+SHOWN_TTL = 86400
+SHOWN_CACHE = cache.LRUCache(5000)
+
+def get_fingerprints(method_name, kwargs):
+    # what a message shows after the edit; editing the text also replaces the markup
+    digest = lambda value: hashlib.md5(json.dumps(value, sort_keys=True)).hexdigest()[:16]
+    fingerprints = {'markup': digest(kwargs.get('reply_markup'))}
+    if method_name == 'edit_message_text':
+        fingerprints['text'] = digest([kwargs.get('text'), kwargs.get('parse_mode'),
+                                       kwargs.get('disable_web_page_preview')])
+    return fingerprints
+
+def record_edit(method_name, kwargs):
+    # returns False if the message already shows what the edit would set; memcache is the
+    # authority, and instance memory only saves reading it when the edit is known to differ
+    key = 'shown:' + get_message_key(kwargs)
+    fingerprints = get_fingerprints(method_name, kwargs)
+    is_shown = lambda shown: all(shown.get(field) == fingerprint for field, fingerprint
+                                 in fingerprints.iteritems())
+
+    shown = SHOWN_CACHE.get(key)
+    if shown is None or is_shown(shown):
+        shown = memcache.get(key) or {}
+        if is_shown(shown):
+            SHOWN_CACHE.set(key, shown)
+            return False
+
+    shown = dict(shown, **fingerprints)
+    SHOWN_CACHE.set(key, shown)
+    memcache.set(key, shown, time=SHOWN_TTL)
+    return True
+
+def forget_edit(kwargs):
+    key = 'shown:' + get_message_key(kwargs)
+    SHOWN_CACHE.delete(key)
+    memcache.delete(key)
+
+def coalesce_edit(method_name, countdown, kwargs):
+    key = get_message_key(kwargs)
+    client = memcache.Client()
+    for _ in range(3):
+        pending = client.gets(key)
+        edit = merge_edits(pending, method_name, kwargs)
+        if pending is None and client.add(key, edit, time=COALESCE_TTL):
+            break
+        if pending is not None and client.cas(key, edit, time=COALESCE_TTL):
+            break
+    else:
+        client.set(key, edit, time=COALESCE_TTL)
+
+    # one task per message per window; it sends whatever edit is pending when it runs
+    now = time.time()
+    slot = int(now / COALESCE_WINDOW)
+    name = 'edit-{}-{}'.format(hashlib.md5(key).hexdigest(), slot)
+    if not client.add(name, 1, time=COALESCE_WINDOW * 2):
+        logging.info('Edit coalesced: ' + method_name)
+        return
+    batch = getattr(_local, 'batch', None)
+    if batch is not None:
+        batch['markers'].append(name)
+
+    countdown = max(schedule(countdown, edit['kwargs']), (slot + 1) * COALESCE_WINDOW - now)
+    payload = json.dumps(edit['kwargs'])
+    add_tasks([taskqueue.Task(url='/telegram/' + edit['method'], payload=payload,
+                              countdown=countdown, name=name, headers={'X-Coalesce-Key': key})])
+    logging.info('Request queued: {} (coalesced, countdown {:.2f}s)'.format(edit['method'],
+                                                                          countdown))
+    logging.debug(payload)
+
+class RateLimiter(object):
+    # Generic cell rate algorithm: memcache holds the theoretical arrival time of the next call,
+    # and a call may go out up to (burst - 1) intervals ahead of it
+    TTL = 3600
+
+    def __init__(self, prefix, interval, burst):
+        self.prefix = prefix
+        self.interval = interval
+        self.tolerance = interval * (burst - 1)
+
+    def reserve(self, name, now):
+        key = self.prefix + name
+        client = memcache.Client()
+        for _ in range(5):
+            arrival = client.gets(key)
+            if arrival is None:
+                if client.add(key, now + self.interval, time=self.TTL):
+                    return 0
+                continue
+            arrival = max(arrival, now)
+            if client.cas(key, arrival + self.interval, time=self.TTL):
+                return max(0, arrival - self.tolerance - now)
+        return 0
+
+    def block(self, name, until):
+        # reserve lets calls out up to tolerance ahead of the stored arrival time, so it is pushed
+        # past until by that much, and nothing goes out before until
+        key = self.prefix + name
+        until += self.tolerance
+        client = memcache.Client()
+        for _ in range(5):
+            arrival = client.gets(key)
+            if arrival is None:
+                if client.add(key, until, time=self.TTL):
+                    return
+            elif arrival >= until or client.cas(key, until, time=self.TTL):
+                return
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_LIMITER = RateLimiter('rate:global', 1.0 / 30, 30)
+PRIVATE_CHAT_LIMITER = RateLimiter('rate:chat:', 1, 3)
+GROUP_CHAT_LIMITER = RateLimiter('rate:group:', 3, 3)
+
+def get_chat_key(kwargs):
+    return kwargs.get('inline_message_id') or str(kwargs.get('chat_id'))
+
+def get_chat_limiter(kwargs):
+    # group and channel chat ids are negative
+    chat_id = kwargs.get('chat_id')
+    if chat_id and int(chat_id) < 0:
+        return GROUP_CHAT_LIMITER
+    return PRIVATE_CHAT_LIMITER
+
+def schedule(countdown, kwargs):
+    now = time.time() + countdown
+    delay = max(GLOBAL_LIMITER.reserve('', now),
+                get_chat_limiter(kwargs).reserve(get_chat_key(kwargs), now))
+    if delay:
+        logging.info('Rate limited: delaying by {:.2f}s'.format(delay))
+    # whole seconds, so that calls in the same request still share a batch task
+    return countdown + int(math.ceil(delay))
+
+def defer(retry_after, kwargs):
+    until = time.time() + retry_after
+    get_chat_limiter(kwargs).block(get_chat_key(kwargs), until)
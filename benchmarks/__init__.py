@@ -0,0 +1 @@
+"""Local benchmarks, run from the repository root with python -m benchmarks.<name>"""
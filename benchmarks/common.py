@@ -0,0 +1,51 @@
+"""Shared setup for benchmarks and local tools that run against the App Engine SDK stubs"""
+
+import imp
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup_sdk(token='BENCHMARK_TOKEN'):
+    # GAE_SDK points at the google_appengine directory of the standalone SDK; token stands in for
+    # the bot token when there is no secrets module
+    sdk_path = os.environ.get('GAE_SDK')
+    if sdk_path and sdk_path not in sys.path:
+        sys.path.insert(0, sdk_path)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    import appengine_config  # pylint: disable=unused-variable
+
+    try:
+        import secrets  # pylint: disable=unused-variable
+    except ImportError:
+        secrets = imp.new_module('secrets')
+        secrets.BOT_TOKEN = token
+        sys.modules['secrets'] = secrets
+
+def activate_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb, testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_urlfetch_stub()
+    ndb.get_context().clear_cache()
+    return bed
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[idx]
+
+def format_ms(seconds):
+    return '{:8.2f}ms'.format(seconds * 1000)
@@ -0,0 +1,40 @@
+"""Measures cold-start import time per module, each in a fresh interpreter, and whether importing
+it pulls in the telegram package
+
+Usage: GAE_SDK=/path/to/google_appengine python -m benchmarks.imports [runs]
+"""
+
+import subprocess
+import sys
+
+from benchmarks import common
+
+MODULES = ['util', 'cache', 'metrics', 'model', 'inline', 'backend', 'admin', 'main', 'worker']
+
+PROBE = '''
+import sys, time
+from benchmarks import common
+common.setup_sdk()
+start = time.time()
+import {module}
+print('{{}} {{}}'.format(time.time() - start, int('telegram' in sys.modules)))
+'''
+
+def measure(module):
+    output = subprocess.check_output([sys.executable, '-c', PROBE.format(module=module)],
+                                     cwd=common.ROOT)
+    elapsed, telegram_loaded = output.split()[-2:]
+    return float(elapsed), telegram_loaded == '1'
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('{:10} {:>10} {:>10}  {}'.format('module', 'p50', 'max', 'imports telegram'))
+    for module in MODULES:
+        results = [measure(module) for _ in range(runs)]
+        timings = [elapsed for elapsed, _ in results]
+        print('{:10} {} {}  {}'.format(module, common.format_ms(common.percentile(timings, 0.5)),
+                                       common.format_ms(max(timings)),
+                                       'yes' if results[-1][1] else 'no'))
+
+if __name__ == '__main__':
+    main()
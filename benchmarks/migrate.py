@@ -0,0 +1,111 @@
+"""Runs MigratePage over polls stored in the legacy formats, timing each batch, and checks that
+every poll ends up in the compact format with a summary and a ballot for each respondent
+
+Usage: GAE_SDK=/path/to/google_appengine python -m benchmarks.migrate [polls] [respondents]
+"""
+
+import json
+import pickle
+import sys
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+from benchmarks import common
+
+common.setup_sdk()
+
+import webapp2
+from google.appengine.api import apiproxy_stub_map, datastore, datastore_types
+from google.appengine.ext import ndb
+
+from main import APP
+from model import Poll, PollSummary, Option, Ballot
+
+NUM_OPTIONS = 4
+
+def make_legacy_option(title, num_respondents, pickled):
+    people = OrderedDict((str(uid), (u'First{}'.format(uid), u'Last{}'.format(uid)))
+                         for uid in range(num_respondents))
+    if pickled:
+        return pickle.dumps(Option(title, people))
+    return json.dumps({'title': title, 'people': people.items()})
+
+def create_legacy_poll(i, num_respondents):
+    # written through the low-level API, since the model only writes the compact format
+    entity = datastore.Entity('Poll')
+    title = u'Legacy poll {}'.format(i)
+    entity.update({
+        'admin_uid': str(i % 10 + 1),
+        'title': datastore_types.Text(title),
+        'title_short': title.lower(),
+        'active': True,
+        'multi': True,
+        'options': [datastore_types.Text(make_legacy_option(u'Option {}'.format(j),
+                                                            num_respondents, i % 2))
+                    for j in range(NUM_OPTIONS)],
+        'created': datetime.now(),
+    })
+    return datastore.Put(entity).id()
+
+def get(path):
+    request = webapp2.Request.blank(path)
+    start = time.time()
+    response = request.get_response(APP)
+    elapsed = time.time() - start
+    if response.status_int != 200:
+        raise RuntimeError('{} for {}'.format(response.status, path))
+    return elapsed
+
+def run_migration():
+    # the first batch is requested directly, and each next batch comes from the default queue
+    stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+    timings = [get('/migrate')]
+    while True:
+        tasks = stub.GetTasks('default')
+        if not tasks:
+            return timings
+        for task in tasks:
+            stub.DeleteTask('default', task['name'])
+            timings.append(get(task['url']))
+
+def check(poll_ids, num_respondents):
+    failures = []
+    polls = [Poll.get_by_id(poll_id, use_cache=False) for poll_id in poll_ids]
+    summaries = [PollSummary.get_by_id(poll_id, use_cache=False) for poll_id in poll_ids]
+    for poll_id, poll, summary in zip(poll_ids, polls, summaries):
+        if poll.has_legacy_options():
+            failures.append('poll {} still has legacy options'.format(poll_id))
+        if not summary:
+            failures.append('poll {} has no summary'.format(poll_id))
+        elif summary.num_respondents != num_respondents:
+            failures.append('poll {} summary counts {} respondents, not {}'.format(
+                poll_id, summary.num_respondents, num_respondents))
+        # every respondent chose every option
+        ballots = ndb.get_multi([Ballot.key_for(poll_id, uid) for uid in range(num_respondents)])
+        if not poll.ballots_complete or not all(ballot and ballot.opt_ids == range(NUM_OPTIONS)
+                                                for ballot in ballots):
+            failures.append('poll {} is missing ballots'.format(poll_id))
+    return failures
+
+def main():
+    num_polls = int(sys.argv[1]) if len(sys.argv) > 1 else 250
+    num_respondents = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    bed = common.activate_testbed()
+    poll_ids = [create_legacy_poll(i, num_respondents) for i in range(num_polls)]
+    timings = run_migration()
+    failures = check(poll_ids, num_respondents)
+    bed.deactivate()
+
+    print('{} legacy polls, {} respondents each: {} batches, p50 {} max {}'.format(
+        num_polls, num_respondents, len(timings), common.format_ms(common.percentile(timings, 0.5)),
+        common.format_ms(max(timings))))
+    for failure in failures:
+        print('FAILED ' + failure)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Compares the legacy JSON option encoding with the compact lazily decoded one
+
+Usage: GAE_SDK=/path/to/google_appengine python -m benchmarks.option_storage
+"""
+
+import json
+import timeit
+
+from collections import OrderedDict
+
+from benchmarks import common
+
+common.setup_sdk()
+
+from model import Poll, Option
+
+NUM_OPTIONS = 4
+RESPONDENT_COUNTS = [10, 100, 1000, 10000]
+
+def legacy_encode(opt):
+    return json.dumps({'title': opt.title, 'people': opt.people.items()})
+
+def legacy_decode(value):
+    json_opt = json.loads(value)
+    return Option(title=json_opt['title'], people=OrderedDict(json_opt['people']))
+
+def make_options(num_respondents):
+    options = [Option(u'Option {}'.format(i)) for i in range(NUM_OPTIONS)]
+    for uid in range(num_respondents):
+        profile = {'first_name': u'First{}'.format(uid), 'last_name': u'Last{}'.format(uid)}
+        options[uid % NUM_OPTIONS].toggle(uid, profile)
+    return options
+
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+def main():
+    prop = Poll.options
+    print('{:>8} {:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'people', 'format', 'save', 'load titles', 'load names', 'bytes'))
+
+    for num_respondents in RESPONDENT_COUNTS:
+        options = make_options(num_respondents)
+        number = max(1, 10000 // num_respondents)
+
+        legacy_values = [legacy_encode(opt) for opt in options]
+        compact_values = [prop._to_base_type(opt) for opt in options]  # pylint: disable=protected-access
+
+        def legacy_titles():
+            return [legacy_decode(value).title for value in legacy_values]
+
+        def legacy_names():
+            return [legacy_decode(value).people for value in legacy_values]
+
+        def compact_titles():
+            return [prop._from_base_type(value).title for value in compact_values]  # pylint: disable=protected-access
+
+        def compact_names():
+            return [prop._from_base_type(value).people for value in compact_values]  # pylint: disable=protected-access
+
+        rows = [
+            ('legacy', lambda: [legacy_encode(opt) for opt in options], legacy_titles,
+             legacy_names, legacy_values),
+            ('compact', lambda: [prop._to_base_type(opt) for opt in options], compact_titles,  # pylint: disable=protected-access
+             compact_names, compact_values),
+        ]
+        for name, save, load_titles, load_names, values in rows:
+            print('{:>8} {:>8} {} {} {} {:>12}'.format(
+                num_respondents, name, common.format_ms(measure(save, number)),
+                common.format_ms(measure(load_titles, number)),
+                common.format_ms(measure(load_names, number)), sum(len(v) for v in values)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Replays Telegram updates through main.APP against the in-memory SDK stubs, reporting latency,
+RPC counts and datastore bytes written per handler; messages queued by the webhook are reported
+as message.queued, and are handled right after it and reported as worker.<handler>
+
+Usage: GAE_SDK=/path/to/google_appengine python -m benchmarks.replay [options]
+
+  --updates FILE    replay recorded updates (one JSON update per line) instead of synthetic ones
+  --voters N        number of distinct voters in the synthetic workload (default 200)
+  --save FILE       write the results as JSON
+  --baseline FILE   compare each handler with saved results, before and after, and exit non-zero
+                    on a regression
+"""
+
+import argparse
+import base64
+import collections
+import json
+import sys
+import time
+
+from benchmarks import common, updates
+
+common.setup_sdk()
+
+import webapp2
+from google.appengine.api import apiproxy_stub_map
+
+from main import APP, MainPage
+from model import Poll, Option
+from secrets import BOT_TOKEN
+
+ADMIN_UID = 1000
+COMMANDS = ['/start', '/polls', '/view_', '/done']
+LATENCY_TOLERANCE = 1.2
+RPC_TOLERANCE = 1.0
+
+class RpcCounter(object):
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.bytes_written = 0
+
+    def count(self, service, call, request, response):  # pylint: disable=unused-argument
+        self.counts['{}.{}'.format(service, call)] += 1
+        if service == 'datastore_v3' and call == 'Put':
+            self.bytes_written += request.ByteSize()
+
+    def reset(self):
+        counts, bytes_written = self.counts, self.bytes_written
+        self.counts, self.bytes_written = collections.Counter(), 0
+        return counts, bytes_written
+
+def get_handler(payload):
+    # named as main.py names its metrics
+    update = json.loads(payload)
+    if 'message' in update:
+        text = update['message'].get('text', '')
+        for command in COMMANDS:
+            if text.startswith(command):
+                return 'message.' + command.strip('/_')
+        return 'message.text'
+    if 'callback_query' in update:
+        action = update['callback_query'].get('data', '').split(' ')[-1]
+        return 'callback_query.' + ('vote' if action.isdigit() else action)
+    if 'inline_query' in update:
+        return 'inline_query'
+    return 'other'
+
+def post_update(payload, path='/' + BOT_TOKEN):
+    request = webapp2.Request.blank(path, POST=payload)
+    request.method = 'POST'
+    request.headers['Content-Type'] = 'application/json'
+    start = time.time()
+    response = request.get_response(APP)
+    elapsed = time.time() - start
+    if response.status_int != 200:
+        raise RuntimeError('{} for {}'.format(response.status, payload))
+    return elapsed
+
+def drain_inbox():
+    stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+    for task in stub.GetTasks(MainPage.INBOX):
+        stub.DeleteTask(MainPage.INBOX, task['name'])
+        yield base64.b64decode(task['body'])
+
+def seed_poll():
+    poll = Poll.new(admin_uid=str(ADMIN_UID), title=u'Replay poll')
+    poll.options = [Option(u'Option {}'.format(i)) for i in range(4)]
+    return poll.put().id()
+
+def generate_synthetic(num_voters):
+    poll_id = seed_poll()
+    yield updates.message(ADMIN_UID, '/start')
+    yield updates.message(ADMIN_UID, 'Dinner on Friday?')
+    for i in range(3):
+        yield updates.message(ADMIN_UID, 'Option {}'.format(i))
+    yield updates.message(ADMIN_UID, '/done')
+    for i in range(num_voters):
+        uid = i + 1
+        yield updates.callback_query(uid, '{} {}'.format(poll_id, uid % 4),
+                                     inline_message_id='IMID')
+        if i % 20 == 0:
+            yield updates.callback_query(ADMIN_UID, '{} refresh'.format(poll_id))
+            yield updates.message(ADMIN_UID, '/view_{}'.format(poll_id))
+            yield updates.message(ADMIN_UID, '/polls')
+    for text in ['', 'r', 're', 'rep', 'replay', 'din', 'dinner']:
+        yield updates.inline_query(ADMIN_UID, text)
+
+def load_recorded(path):
+    with open(path) as recorded:
+        for line in recorded:
+            if line.strip():
+                yield line.strip()
+
+def replay(payloads):
+    counter = RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('replay_counter', counter.count)
+
+    latencies = collections.defaultdict(list)
+    rpcs = collections.defaultdict(collections.Counter)
+    bytes_written = collections.Counter()
+    def measure(payload, path='/' + BOT_TOKEN):
+        counter.reset()
+        elapsed = post_update(payload, path)
+        counts, written = counter.reset()
+        return elapsed, counts, written
+
+    def record(handler, measurement):
+        elapsed, counts, written = measurement
+        latencies[handler].append(elapsed)
+        rpcs[handler].update(counts)
+        bytes_written[handler] += written
+
+    for payload in payloads:
+        measurement = measure(payload)
+        queued = list(drain_inbox())
+        record('message.queued' if queued else get_handler(payload), measurement)
+        for queued_payload in queued:
+            record('worker.' + get_handler(queued_payload),
+                   measure(queued_payload, '/tasks/update'))
+
+    results = {}
+    for handler, values in latencies.items():
+        count = len(values)
+        results[handler] = {
+            'count': count,
+            'p50': common.percentile(values, 0.5),
+            'p99': common.percentile(values, 0.99),
+            'rpcs': dict((name, float(total) / count) for name, total in rpcs[handler].items()),
+            'bytes_written': float(bytes_written[handler]) / count,
+        }
+    return results
+
+def report(results):
+    for handler, result in sorted(results.items()):
+        print('{} x{}: p50 {} p99 {} datastore bytes written {:.0f}/update'.format(
+            handler, result['count'], common.format_ms(result['p50']),
+            common.format_ms(result['p99']), result['bytes_written']))
+        for name, per_update in sorted(result['rpcs'].items()):
+            print('    {:40} {:6.2f}/update'.format(name, per_update))
+
+def report_comparison(results, baseline):
+    print('{:24} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+        'handler', 'before p50', 'after p50', 'before p99', 'after p99', 'p99'))
+    for handler in sorted(set(results) & set(baseline)):
+        base, result = baseline[handler], results[handler]
+        change = result['p99'] / base['p99'] - 1 if base['p99'] else 0.0
+        print('{:24} {} {} {} {} {:>+8.0%}'.format(
+            handler, common.format_ms(base['p50']), common.format_ms(result['p50']),
+            common.format_ms(base['p99']), common.format_ms(result['p99']), change))
+
+def compare(results, baseline):
+    regressions = []
+    for handler, result in results.items():
+        base = baseline.get(handler)
+        if not base:
+            continue
+        if result['p99'] > base['p99'] * LATENCY_TOLERANCE:
+            regressions.append('{} p99 {} -> {}'.format(handler, common.format_ms(base['p99']),
+                                                        common.format_ms(result['p99'])))
+        for name, per_update in result['rpcs'].items():
+            if per_update > base['rpcs'].get(name, 0) * RPC_TOLERANCE + 1e-9:
+                regressions.append('{} {} {:.2f} -> {:.2f}/update'.format(
+                    handler, name, base['rpcs'].get(name, 0), per_update))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates')
+    parser.add_argument('--voters', type=int, default=200)
+    parser.add_argument('--save')
+    parser.add_argument('--baseline')
+    args = parser.parse_args()
+
+    bed = common.activate_testbed()
+    if args.updates:
+        payloads = load_recorded(args.updates)
+    else:
+        payloads = generate_synthetic(args.voters)
+    results = replay(payloads)
+    bed.deactivate()
+
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as saved:
+            json.dump(results, saved, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as saved:
+            baseline = json.load(saved)
+        report_comparison(results, baseline)
+        regressions = compare(results, baseline)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""Builders for synthetic Telegram updates"""
+
+import itertools
+import json
+
+_update_ids = itertools.count(1)
+
+def make_user(uid):
+    return {'id': uid, 'is_bot': False, 'first_name': u'User{}'.format(uid),
+            'last_name': u'Last{}'.format(uid), 'username': u'user{}'.format(uid)}
+
+def message(uid, text):
+    update_id = next(_update_ids)
+    chat = {'id': uid, 'type': 'private', 'first_name': u'User{}'.format(uid)}
+    return json.dumps({'update_id': update_id, 'message': {
+        'message_id': update_id, 'from': make_user(uid), 'chat': chat, 'date': 1500000000,
+        'text': text}})
+
+def callback_query(uid, data, inline_message_id=None, admin_uid=None):
+    update_id = next(_update_ids)
+    query = {'id': str(update_id), 'from': make_user(uid), 'chat_instance': '1', 'data': data}
+    if inline_message_id:
+        query['inline_message_id'] = inline_message_id
+    else:
+        chat = {'id': admin_uid or uid, 'type': 'private'}
+        query['message'] = {'message_id': 1, 'chat': chat, 'date': 1500000000}
+    return json.dumps({'update_id': update_id, 'callback_query': query})
+
+def inline_query(uid, query, offset=''):
+    update_id = next(_update_ids)
+    return json.dumps({'update_id': update_id, 'inline_query': {
+        'id': str(update_id), 'from': make_user(uid), 'query': query, 'offset': offset}})
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of utf16.uslice against the previous character-by-character implementation
+
+Needs no SDK. Usage: python -m benchmarks.uslice
+"""
+
+import timeit
+
+import utf16
+from benchmarks import common
+
+TITLE_LENGTH = 3072
+TITLES = [
+    ('ascii', u'Dinner at the usual place on Friday? ' * 100),
+    # written as surrogate pairs so that wide builds take the same path as narrow ones
+    ('emoji', u'\ud83c\udf55\ud83c\udf7a party \ud83c\udf89 ' * 320),
+    ('cjk', u'星期五晚上一起吃饭吗？' * 300),
+]
+SLICES = [(0, 65), (0, 512)]
+
+def legacy_is_surrogate(string, i):
+    if 0xD800 <= ord(string[i]) <= 0xDBFF:
+        try:
+            char = string[i + 1]
+        except IndexError:
+            return False
+        if 0xDC00 <= ord(char) <= 0xDFFF:
+            return True
+        else:
+            raise ValueError("Illegal UTF-16 sequence: %r" % string[i:i + 2])
+    else:
+        return False
+
+def legacy_uslice(string, start, end):
+    length = len(string)
+    i = 0
+    while i < start and i < length:
+        if legacy_is_surrogate(string, i):
+            start += 1
+            end += 1
+            i += 1
+        i += 1
+    while i < end and i < length:
+        if legacy_is_surrogate(string, i):
+            end += 1
+            i += 1
+        i += 1
+    return string[start:end]
+
+def measure(func, number=2000):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+def main():
+    print('{:>6} {:>10} {:>12} {:>12} {:>8}'.format('title', 'slice', 'legacy', 'utf16',
+                                                    'speedup'))
+    for name, title in TITLES:
+        title = title[:TITLE_LENGTH]
+        for start, end in SLICES:
+            assert legacy_uslice(title, start, end) == utf16.uslice(title, start, end)
+            legacy = measure(lambda: legacy_uslice(title, start, end))
+            fast = measure(lambda: utf16.uslice(title, start, end))
+            print('{:>6} {:>10} {} {} {:>7.1f}x'.format(
+                name, '{}:{}'.format(start, end), common.format_ms(legacy),
+                common.format_ms(fast), legacy / fast))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Simulates N concurrent voters on one poll, comparing the sharded vote log to the legacy
+single-entity transaction
+
+Usage: GAE_SDK=/path/to/google_appengine python -m benchmarks.vote_contention [voters] [options]
+"""
+
+import sys
+import threading
+import time
+
+from benchmarks import common
+
+common.setup_sdk()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+from model import Poll, Option
+
+def legacy_toggle(poll_id, opt_id, uid, user_profile):
+    @ndb.transactional
+    def txn():
+        poll = Poll.get_by_id(poll_id)
+        status = poll.options[opt_id].toggle(uid, user_profile)
+        poll.put()
+        return poll, status
+    return txn()
+
+def create_poll(num_options):
+    poll = Poll.new(admin_uid='1', title=u'Contention benchmark')
+    poll.options = [Option(u'Option {}'.format(i)) for i in range(num_options)]
+    return poll.put().id()
+
+def run(toggle, num_voters, num_options):
+    poll_id = create_poll(num_options)
+    counts = {'BeginTransaction': 0, 'Commit': 0}
+    latencies = []
+    failures = []
+
+    def count_call(service, call, request, response):  # pylint: disable=unused-argument
+        if service == 'datastore_v3' and call in counts:
+            counts[call] += 1
+
+    hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+    hooks.Append('contention_counter', count_call)
+
+    def vote(uid):
+        profile = {'first_name': u'Voter{}'.format(uid), 'last_name': None}
+        start = time.time()
+        try:
+            toggle(poll_id, uid % num_options, uid, profile)
+        except Exception as exception:  # pylint: disable=broad-except
+            failures.append(exception)
+        latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=vote, args=(uid,)) for uid in range(1, num_voters + 1)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    hooks.Clear()
+
+    return {'elapsed': elapsed, 'p50': common.percentile(latencies, 0.5),
+            'p99': common.percentile(latencies, 0.99), 'failures': len(failures),
+            'attempts': counts['BeginTransaction'], 'commits': counts['Commit']}
+
+def main():
+    num_voters = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_options = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    print('{} concurrent voters, {} options'.format(num_voters, num_options))
+    for name, toggle in [('legacy', legacy_toggle), ('sharded', Poll.toggle)]:
+        bed = common.activate_testbed()
+        result = run(toggle, num_voters, num_options)
+        bed.deactivate()
+        print('{:8} total {} p50 {} p99 {} txn attempts {:5} failed votes {}'.format(
+            name, common.format_ms(result['elapsed']), common.format_ms(result['p50']),
+            common.format_ms(result['p99']), result['attempts'], result['failures']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Instance memory and memcache caching helpers"""
+
+import functools
+import threading
+
+from collections import OrderedDict
+
+import metrics
+
+from google.appengine.api import memcache
+
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+class RenderCache(object):
+    # one record per entity holding every rendering of its current version, so that a version
+    # change invalidates all of them at once
+    def __init__(self, namespace, maxsize=500, ttl=3600):
+        self.namespace = namespace
+        self.local = LRUCache(maxsize)
+        self.ttl = ttl
+
+    def make_key(self, entity_id):
+        return '{}:{}'.format(self.namespace, entity_id)
+
+    def get(self, entity_id, version, name, compute):
+        key = self.make_key(entity_id)
+        record = self.local.get(key)
+        if not record or record[0] != version or name not in record[1]:
+            remote = memcache.get(key)
+            if remote and remote[0] == version:
+                record = remote
+            elif not record or record[0] != version:
+                record = (version, {})
+            if name not in record[1]:
+                values = dict(record[1])
+                values[name] = compute()
+                record = (version, values)
+                memcache.set(key, record, time=self.ttl)
+            self.local.set(key, record)
+        return record[1][name]
+
+    def invalidate(self, entity_id):
+        key = self.make_key(entity_id)
+        self.local.delete(key)
+        memcache.delete(key)
+
+def memoize_render(render_cache):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.key:
+                return method(self, *args, **kwargs)
+            name = method.__name__ + repr(args) + repr(sorted(kwargs.items()))
+            def compute():
+                with metrics.timer('render.' + method.__name__):
+                    return method(self, *args, **kwargs)
+            return render_cache.get(self.key.id(), self.get_version(), name, compute)
+        return wrapper
+    return decorator
@@ -0,0 +1,117 @@
+"""Precomputed inline query results, indexed per poll creator"""
+
+import util
+from model import Poll, PollSummary
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+THUMB_URL = 'https://countmeinbot.appspot.com/thumb.jpg'
+PAGE_SIZE = 10
+INDEX_LIMIT = 500
+MAX_QUERY_TOKENS = 5
+TTL = 86400
+
+def get_index_key(uid):
+    return 'inline_index:{}'.format(uid)
+
+def get_result_key(poll_id):
+    return 'inline_result:{}'.format(poll_id)
+
+def build_result(poll):
+    content = {'message_text': poll.render_text(), 'parse_mode': 'HTML'}
+    return {'type': 'article', 'id': str(poll.key.id()), 'title': poll.title,
+            'description': poll.generate_options_summary(), 'input_message_content': content,
+            'reply_markup': poll.build_vote_buttons(), 'thumb_url': THUMB_URL}
+
+def build_index(uid):
+    # the words of each poll, newest first; a query matches a poll when each of its words is a
+    # prefix of one of the poll's words
+    query = PollSummary.query(PollSummary.admin_uid == uid).order(-PollSummary.created)
+    summaries = query.fetch(INDEX_LIMIT, projection=[PollSummary.words])
+    entries = [(summary.key.id(), summary.get_words()) for summary in summaries]
+    return {'entries': entries, 'complete': len(entries) < INDEX_LIMIT}
+
+def load_index(uid):
+    index = memcache.get(get_index_key(uid))
+    if index is None:
+        index = build_index(uid)
+        # add, so that an index seeded by add_poll in the meantime is not replaced
+        memcache.add(get_index_key(uid), index, time=TTL)
+    return index
+
+def query_poll_ids(uid, tokens):
+    # token search beyond the cached index, for creators with more than INDEX_LIMIT polls; the
+    # datastore matches the longest token and returns the newest polls first
+    token = max(tokens, key=len)[:PollSummary.MAX_PREFIX]
+    query = PollSummary.query(PollSummary.admin_uid == uid,
+                              PollSummary.search_tokens == token).order(-PollSummary.created)
+    return [summary.key.id() for summary in query.fetch(50, projection=[PollSummary.words])
+            if PollSummary.matches(summary.get_words(), tokens)]
+
+def get_results(uid, text, offset=0):
+    tokens = util.tokenize(text, MAX_QUERY_TOKENS)
+    index = load_index(uid)
+    poll_ids = [poll_id for poll_id, words in index['entries']
+                if PollSummary.matches(words, tokens)]
+    if not poll_ids and not index['complete'] and tokens:
+        poll_ids = query_poll_ids(uid, tokens)
+
+    page = poll_ids[offset:offset + PAGE_SIZE]
+    next_offset = str(offset + PAGE_SIZE) if len(poll_ids) > offset + PAGE_SIZE else ''
+
+    result_keys = [get_result_key(poll_id) for poll_id in page]
+    results = memcache.get_multi(result_keys)
+    missing = [ndb.Key(Poll, poll_id) for poll_id, key in zip(page, result_keys)
+               if key not in results]
+    if missing:
+        fresh = {}
+        polls = ndb.get_multi(missing)
+        Poll.load_pages(polls, stop=Poll.TEXT_POSITIONS)
+        for poll in polls:
+            if poll:
+                fresh[get_result_key(poll.key.id())] = build_result(poll)
+        memcache.set_multi(fresh, time=TTL)
+        results.update(fresh)
+
+    return [results[key] for key in result_keys if key in results], next_offset
+
+def update_index(uid, update):
+    # returns False if there is no index to update, or it had to be dropped
+    client = memcache.Client()
+    key = get_index_key(uid)
+    for _ in range(3):
+        index = client.gets(key)
+        if index is None:
+            return False
+        update(index)
+        if client.cas(key, index, time=TTL):
+            return True
+    client.delete(key)
+    return False
+
+def add_poll(poll):
+    words = PollSummary.from_poll(poll).get_words()
+    def update(index):
+        index['entries'] = [(poll.key.id(), words)] + [entry for entry in index['entries']
+                                                       if entry[0] != poll.key.id()]
+        if len(index['entries']) > INDEX_LIMIT:
+            index['entries'] = index['entries'][:INDEX_LIMIT]
+            index['complete'] = False
+    if update_index(poll.admin_uid, update):
+        return
+    # the query behind a rebuilt index may not see the new poll yet, so the index is seeded here
+    # with the poll merged in
+    index = build_index(poll.admin_uid)
+    update(index)
+    memcache.set(get_index_key(poll.admin_uid), index, time=TTL)
+
+def update_poll(poll):
+    memcache.replace(get_result_key(poll.key.id()), build_result(poll), time=TTL)
+
+def remove_poll(poll):
+    poll_id = poll.key.id()
+    def update(index):
+        index['entries'] = [entry for entry in index['entries'] if entry[0] != poll_id]
+    update_index(poll.admin_uid, update)
+    memcache.delete(get_result_key(poll_id))
@@ -1,20 +1,19 @@
 """Main CountMeIn Bot app"""
 
 import logging
-import warnings
 import json
 
 import util
 import backend
-from model import User, Respondent, Poll, Option
+import inline
+import metrics
+from model import User, Respondent, Poll, PollSummary, Draft
 from secrets import BOT_TOKEN
 
 import webapp2
-from google.appengine.api import memcache
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
 from google.appengine.runtime import apiproxy_errors
-from telegram.vendor.ptb_urllib3.urllib3.contrib.appengine import AppEnginePlatformWarning
-
-warnings.simplefilter("ignore", AppEnginePlatformWarning)
 
 class FrontPage(webapp2.RequestHandler):
     def get(self):
@@ -36,24 +35,75 @@ class MainPage(webapp2.RequestHandler):
     ERROR_OVER_QUOTA = 'Sorry, CountMeIn Bot is overloaded right now. Please try again later!'
     ERROR_TITLE_TOO_LONG = 'Sorry, please enter a shorter title ' + \
                            '(maximum {} characters).'.format(TITLE_MAX_LENGTH)
-    THUMB_URL = 'https://countmeinbot.appspot.com/thumb.jpg'
+    THUMB_URL = inline.THUMB_URL
+
+    INBOX = 'inbox'
+    DEDUP_TTL = 86400
 
     update = None
+    vote_recorded = False
 
+    @metrics.flushed
+    @backend.batch_api_calls
+    @ndb.toplevel
     def post(self):
         logging.debug(self.request.body)
         self.update = backend.parse_update(self.request.body)
 
+        # Telegram resends updates that were not acknowledged in time, and a resent vote would
+        # undo itself; add also fails when memcache is down, so the key is read back before an
+        # update is dropped
+        dedup_key = 'update:{}'.format(self.update.update_id)
+        if not memcache.add(dedup_key, 1, time=self.DEDUP_TTL) and memcache.get(dedup_key):
+            logging.info('Duplicate update {}'.format(self.update.update_id))
+            metrics.incr('update.duplicate')
+            return
+
+        # messages are answered with separate api calls, so they can be handled after the webhook
+        # has returned; callback and inline queries are answered in the response, and messages
+        # that change a draft stay here too, since queued tasks for one chat may run out of order
+        if self.update.message and not self.changes_draft(self.update.message):
+            try:
+                taskqueue.add(queue_name=self.INBOX, url='/tasks/update', payload=self.request.body)
+            except Exception:
+                memcache.delete(dedup_key)
+                raise
+            logging.info('Incoming message queued')
+            metrics.incr('update.queued')
+            return
+
+        # a failed update is resent by Telegram, and must get through unless its vote is already in
+        try:
+            yield self.handle_update()
+        except Exception:
+            if not self.vote_recorded:
+                memcache.delete(dedup_key)
+            raise
+
+    @staticmethod
+    def changes_draft(message):
+        text = message.text
+        return bool(text) and text != '/polls' and not text.startswith('/view_')
+
+    @ndb.tasklet
+    def handle_update(self):
         if self.update.message:
             logging.info('Processing incoming message')
-            self.handle_message()
+            with metrics.timer('main.message'):
+                yield self.handle_message()
         elif self.update.callback_query:
             logging.info('Processing incoming callback query')
-            self.handle_callback_query()
+            with metrics.timer('main.callback_query'):
+                yield self.handle_callback_query()
         elif self.update.inline_query:
             logging.info('Processing incoming inline query')
-            self.handle_inline_query()
+            with metrics.timer('main.inline_query'):
+                self.handle_inline_query()
+
+    def record_vote(self):
+        self.vote_recorded = True
 
+    @ndb.tasklet
     def handle_message(self):
         message = self.update.message
 
@@ -67,29 +117,25 @@ class MainPage(webapp2.RequestHandler):
 
         text = message.text
         uid = str(message.chat.id)
-        responding_to = memcache.get(uid)
+        draft_future = Draft.load_async(uid)
 
         def deliver_poll(poll):
             backend.send_message(0.5, chat_id=uid, text=poll.render_text(), parse_mode='HTML',
                                  reply_markup=poll.build_admin_buttons())
 
+        # /polls and /view_ leave a draft in progress alone, so the next free text message still
+        # goes into it; /start replaces it, datastore copy included
         if text.startswith('/start'):
+            metrics.incr('message.start')
             backend.send_message(chat_id=uid, text=self.NEW_POLL)
-            memcache.set(uid, value='START', time=3600)
-            return
-
-        elif text == '/done' and responding_to and responding_to.startswith('OPT '):
-            poll = Poll.get_by_id(int(responding_to[4:]))
-            if not poll.options:
-                backend.send_message(chat_id=uid, text=self.ERROR_PREMATURE_DONE)
-                return
-            backend.send_message(chat_id=uid, text=self.DONE)
-            deliver_poll(poll)
+            yield Draft(id=uid, options=[]).save_async()
 
         elif text == '/polls':
+            metrics.incr('message.polls')
             header = [util.make_html_bold('Your polls')]
 
-            recent_polls = Poll.query(Poll.admin_uid == uid).order(-Poll.created).fetch(30)
+            query = PollSummary.query(PollSummary.admin_uid == uid).order(-PollSummary.created)
+            recent_polls = yield query.fetch_async(30)
             body = [u'{}. {}'.format(i + 1, poll.generate_poll_summary_with_link()) for i, poll
                     in enumerate(recent_polls)]
 
@@ -100,40 +146,59 @@ class MainPage(webapp2.RequestHandler):
             backend.send_message(chat_id=uid, text=output, parse_mode='HTML')
 
         elif text.startswith('/view_'):
+            metrics.incr('message.view')
             try:
-                poll = Poll.get_by_id(int(text[6:]))
+                poll = yield Poll.get_live_async(int(text[6:]))
                 if not poll or poll.admin_uid != uid:
                     raise ValueError
+                if poll.restored:
+                    inline.add_poll(poll)
                 deliver_poll(poll)
             except ValueError:
                 backend.send_message(chat_id=uid, text=self.HELP)
 
-        elif responding_to == 'START':
-            if len(text) > self.TITLE_MAX_LENGTH:
-                backend.send_message(chat_id=uid, text=self.ERROR_TITLE_TOO_LONG)
-                return
-            new_poll_key = Poll.new(admin_uid=uid, title=text).put()
-            bold_title = util.make_html_bold_first_line(text)
-            backend.send_message(chat_id=uid, text=self.FIRST_OPTION.format(bold_title),
-                                 parse_mode='HTML')
-            memcache.set(uid, value='OPT {}'.format(new_poll_key.id()), time=3600)
-            return
-
-        elif responding_to and responding_to.startswith('OPT '):
-            poll = Poll.get_by_id(int(responding_to[4:]))
-            poll.options.append(Option(text))
-            poll.put()
-            if len(poll.options) < 10:
-                backend.send_message(chat_id=uid, text=self.NEXT_OPTION)
-                return
-            backend.send_message(chat_id=uid, text=self.DONE)
-            deliver_poll(poll)
-
         else:
-            backend.send_message(chat_id=uid, text=self.HELP)
+            # the poll under construction lives in the draft until it is committed in one write
+            draft = yield draft_future
+
+            if text == '/done' and draft and draft.title:
+                metrics.incr('message.done')
+                if not draft.options:
+                    backend.send_message(chat_id=uid, text=self.ERROR_PREMATURE_DONE)
+                    return
+                poll = yield draft.commit_async()
+                inline.add_poll(poll)
+                backend.send_message(chat_id=uid, text=self.DONE)
+                deliver_poll(poll)
 
-        memcache.delete(uid)
+            elif draft and not draft.title:
+                metrics.incr('message.title')
+                if len(text) > self.TITLE_MAX_LENGTH:
+                    backend.send_message(chat_id=uid, text=self.ERROR_TITLE_TOO_LONG)
+                    return
+                draft.title = text
+                bold_title = util.make_html_bold_first_line(text)
+                backend.send_message(chat_id=uid, text=self.FIRST_OPTION.format(bold_title),
+                                     parse_mode='HTML')
+                yield draft.save_async()
+
+            elif draft:
+                metrics.incr('message.option')
+                draft.options.append(text)
+                if len(draft.options) < 10:
+                    backend.send_message(chat_id=uid, text=self.NEXT_OPTION)
+                    yield draft.save_async()
+                    return
+                poll = yield draft.commit_async()
+                inline.add_poll(poll)
+                backend.send_message(chat_id=uid, text=self.DONE)
+                deliver_poll(poll)
 
+            else:
+                metrics.incr('message.help')
+                backend.send_message(chat_id=uid, text=self.HELP)
+
+    @ndb.tasklet
     def handle_callback_query(self):
         callback_query = self.update.callback_query
 
@@ -158,15 +223,25 @@ class MainPage(webapp2.RequestHandler):
             self.answer_callback_query('Invalid data. This attempt will be logged!')
             return
 
-        poll = Poll.get_by_id(poll_id)
+        metrics.incr('callback_query.' + ('vote' if action.isdigit() else action))
+
+        # a vote reads the poll once, inside the toggle, instead of fetching it beforehand
+        if action.isdigit():
+            poll, status = yield Poll.toggle_async(poll_id, int(action), uid, user_profile,
+                                                   on_recorded=self.record_vote)
+        else:
+            poll = yield Poll.get_live_async(poll_id)
+
         if not poll:
             backend.api_call('edit_message_reply_markup',
                              inline_message_id=imid, chat_id=chat_id, message_id=mid)
             self.answer_callback_query('Sorry, this poll has been deleted')
             return
+        if poll.restored:
+            inline.add_poll(poll)
 
         if action.isdigit():
-            poll, status = Poll.toggle(poll_id, int(action), uid, user_profile)
+            inline.update_poll(poll)
             backend.api_call('edit_message_text',
                              inline_message_id=imid, chat_id=chat_id, message_id=mid,
                              text=poll.render_text(), parse_mode='HTML',
@@ -184,7 +259,8 @@ class MainPage(webapp2.RequestHandler):
                              reply_markup=poll.build_vote_buttons(admin=True))
 
         elif action == 'delete' and is_admin:
-            poll.key.delete()
+            yield poll.key.delete_async()
+            inline.remove_poll(poll)
             status = 'Poll deleted!'
             backend.api_call('edit_message_reply_markup', chat_id=chat_id, message_id=mid)
 
@@ -203,34 +279,24 @@ class MainPage(webapp2.RequestHandler):
         inline_query = self.update.inline_query
 
         text = inline_query.query.lower()
-
         uid = str(inline_query.from_user.id)
-        query = Poll.query(Poll.admin_uid == uid,
-                           Poll.title_short >= text, Poll.title_short < text + u'\ufffd')
-
-        results = []
-        polls = sorted(query.fetch(50), key=lambda poll: poll.created, reverse=True)
-        for poll in polls:
-            qr_id = str(poll.key.id())
-            qr_title = poll.title
-            qr_description = poll.generate_options_summary()
-            content = {'message_text': poll.render_text(), 'parse_mode': 'HTML'}
-            reply_markup = poll.build_vote_buttons()
-            result = {'type': 'article', 'id': qr_id, 'title': qr_title,
-                      'description': qr_description, 'input_message_content': content,
-                      'reply_markup': reply_markup, 'thumb_url': self.THUMB_URL}
-            results.append(result)
-
-        self.answer_inline_query(results)
+        try:
+            offset = int(inline_query.offset or 0)
+        except ValueError:
+            offset = 0
+
+        results, next_offset = inline.get_results(uid, text, offset)
+        self.answer_inline_query(results, next_offset)
 
     def answer_callback_query(self, status):
         qid = self.update.callback_query.id
         self.write_request('answerCallbackQuery', callback_query_id=qid, text=status)
 
-    def answer_inline_query(self, results):
+    def answer_inline_query(self, results, next_offset=''):
         qid = self.update.inline_query.id
         self.write_request('answerInlineQuery', inline_query_id=qid, results=results, cache_time=0,
-                           switch_pm_text='Create new poll', switch_pm_parameter='new')
+                           next_offset=next_offset, switch_pm_text='Create new poll',
+                           switch_pm_parameter='new')
 
     def write_request(self, method_name, **kwargs):
         request_data = kwargs.copy()
@@ -266,8 +332,15 @@ class MainPage(webapp2.RequestHandler):
 APP = webapp2.WSGIApplication([
     webapp2.Route('/', FrontPage),
     webapp2.Route('/' + BOT_TOKEN, MainPage),
+    webapp2.Route('/telegram/batch', backend.TelegramBatchPage),
     webapp2.Route('/telegram/<method_name>', backend.TelegramPage),
     webapp2.Route('/migrate', 'admin.MigratePage'),
     webapp2.Route('/polls', 'admin.PollsPage'),
+    webapp2.Route('/metrics', 'admin.MetricsPage'),
     webapp2.Route('/poll/<pid>', 'admin.PollPage'),
+    webapp2.Route('/view/<pid>', 'admin.SignedPollPage'),
+    webapp2.Route('/export/<export_format>', 'admin.ExportPage'),
+    webapp2.Route('/tasks/fold', 'worker.FoldPage'),
+    webapp2.Route('/tasks/update', 'worker.UpdatePage'),
+    webapp2.Route('/tasks/archive', 'worker.ArchivePage'),
 ], debug=True)
@@ -0,0 +1,123 @@
+"""Lightweight hot-path timers and counters"""
+
+import bisect
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+
+from google.appengine.api import memcache
+
+# Measurements are aggregated in instance memory and flushed to memcache at most once per
+# FLUSH_INTERVAL, as one record per instance per flush listed under a per-minute index.
+
+# upper bounds of the histogram buckets, in milliseconds
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+FLUSH_INTERVAL = 60
+TTL = 2 * 3600
+
+_INSTANCE_ID = os.environ.get('INSTANCE_ID') or uuid.uuid4().hex
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_state = {'last_flush': time.time(), 'flushes': 0}
+
+def incr(name, delta=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + delta
+
+def record(name, seconds):
+    bucket = bisect.bisect_left(BUCKETS, seconds * 1000)
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [0] * (len(BUCKETS) + 1)
+        histogram[bucket] += 1
+
+@contextlib.contextmanager
+def timer(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def flushed(func):
+    # for request handlers: flushes once the interval is up, after the response is built
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            maybe_flush()
+    return wrapper
+
+def maybe_flush():
+    now = time.time()
+    with _lock:
+        if now - _state['last_flush'] < FLUSH_INTERVAL:
+            return
+        counters, histograms = dict(_counters), dict(_histograms)
+        _counters.clear()
+        _histograms.clear()
+        _state['last_flush'] = now
+        _state['flushes'] += 1
+        flush_id = '{}:{}'.format(_INSTANCE_ID, _state['flushes'])
+
+    minute = int(now // 60)
+    record_key = 'metrics:{}:{}'.format(minute, flush_id)
+    try:
+        memcache.set(record_key, {'counters': counters, 'histograms': histograms}, time=TTL)
+        add_to_index(get_index_key(minute), record_key)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception('Failed to flush metrics')
+
+def get_index_key(minute):
+    return 'metrics:{}'.format(minute)
+
+def add_to_index(index_key, record_key):
+    client = memcache.Client()
+    for _ in range(5):
+        record_keys = client.gets(index_key)
+        if record_keys is None:
+            if client.add(index_key, [record_key], time=TTL):
+                return
+        elif client.cas(index_key, record_keys + [record_key], time=TTL):
+            return
+
+def load(minutes):
+    current = int(time.time() // 60)
+    index_keys = [get_index_key(minute) for minute in range(current - minutes + 1, current + 1)]
+    record_keys = [key for keys in memcache.get_multi(index_keys).values() for key in keys]
+    counters = {}
+    histograms = {}
+    for flushed_record in memcache.get_multi(record_keys).values():
+        for name, value in flushed_record['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, histogram in flushed_record['histograms'].items():
+            total = histograms.setdefault(name, [0] * (len(BUCKETS) + 1))
+            for i, count in enumerate(histogram):
+                total[i] += count
+    return counters, histograms
+
+def estimate_percentile(histogram, fraction):
+    # upper bound of the bucket holding the percentile, in milliseconds
+    target = fraction * sum(histogram)
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= target and count:
+            return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+    return 0
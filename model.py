@@ -1,15 +1,29 @@
 """Datastore entity models"""
 
-from collections import OrderedDict
-
 import util
+import cache
+import metrics
 import pickle
 import json
+import time
+import hashlib
+import hmac
+import zlib
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import chain, islice, izip
 
+from secrets import BOT_TOKEN
+
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
+PROFILE_CACHE = cache.LRUCache(5000)
 
 class User(ndb.Model):
+    PROFILE_TTL = 86400
+
     first_name = ndb.TextProperty()
     last_name = ndb.TextProperty()
     username = ndb.StringProperty(indexed=False)
@@ -20,9 +34,32 @@ class User(ndb.Model):
     @classmethod
     def populate_by_id(cls, id, **kwargs):  # pylint: disable=redefined-builtin, invalid-name
     # ignore warnings due to argument named "id" for consistency with similar ndb methods
-        entity = cls.get_by_id(id) or cls(id=id)
-        entity.populate(**kwargs)
-        entity.put()
+        # returns without any RPC when the profile is known to be unchanged, otherwise returns a
+        # future that the caller need not wait on (handlers run under ndb.toplevel)
+        fingerprint = cls.get_fingerprint(kwargs)
+        cache_key = 'profile:{}:{}'.format(cls.__name__, id)
+        if PROFILE_CACHE.get(cache_key) == fingerprint:
+            return None
+        return cls.populate_by_id_async(id, cache_key, fingerprint, kwargs)
+
+    @classmethod
+    @ndb.tasklet
+    def populate_by_id_async(cls, id, cache_key, fingerprint, kwargs):  # pylint: disable=redefined-builtin, invalid-name
+        context = ndb.get_context()
+        cached_fingerprint = yield context.memcache_get(cache_key)
+        if cached_fingerprint != fingerprint:
+            entity = yield cls.get_by_id_async(id)
+            entity = entity or cls(id=id)
+            if cls.get_fingerprint(entity.to_dict()) != fingerprint:
+                entity.populate(**kwargs)
+                yield entity.put_async()
+            yield context.memcache_set(cache_key, fingerprint, time=cls.PROFILE_TTL)
+        PROFILE_CACHE.set(cache_key, fingerprint)
+
+    @staticmethod
+    def get_fingerprint(profile):
+        fields = [profile.get('first_name'), profile.get('last_name'), profile.get('username')]
+        return hashlib.md5(json.dumps(fields)).hexdigest()
 
     def get_description(self):
         output = u'{}'.format(self.first_name)
@@ -37,19 +74,60 @@ class Respondent(User):
     updated = ndb.DateTimeProperty(auto_now=True, indexed=True)
 
 class ToJsonProperty(ndb.TextProperty):
+    # Options are stored as '2:' + json([title, count]) + '\n' + json([uid, first, last, ...]),
+    # so that the title and count can be read without decoding every respondent; paged options
+    # add their number of pages and the count on each page to the header. Legacy values
+    # are JSON objects or pickled Options and are rewritten in the compact format on next put.
+    COMPACT_PREFIX = '2:'
+
     def _from_base_type(self, value):
-        try:
+        if value.startswith(self.COMPACT_PREFIX):
+            return Option.decode(value[len(self.COMPACT_PREFIX):])
+        if value.startswith('{'):
             json_opt = json.loads(value)
-            return Option(title=json_opt['title'], people=OrderedDict(json_opt['people']))
-        except:
+            opt = Option(title=json_opt['title'], people=OrderedDict(json_opt['people']))
+        else:
             opt = pickle.loads(value)
-            return opt
+        opt.legacy = True
+        return opt
 
     def _to_base_type(self, opt):
-        json_opt = {'title': opt.title, 'people': opt.people.items()}
-        return json.dumps(json_opt)
+        return self.COMPACT_PREFIX + opt.encode()
+
+RENDER_CACHE = cache.RenderCache('render')
+
+class PollListing(object):
+    # rendering shared by Poll and PollSummary, which both have admin_uid, title, title_short and
+    # created, and know their number of respondents without decoding the options
+    def generate_respondents_summary(self):
+        num_respondents = self.get_num_respondents()
+        if num_respondents == 0:
+            output = 'Nobody responded'
+        elif num_respondents == 1:
+            output = '1 person responded'
+        else:
+            output = '{} people responded'.format(num_respondents)
+        return output
+
+    def generate_poll_summary_with_link(self):
+        short_bold_title = util.make_html_bold(util.uslice(self.title, 0, 65))
+        respondents_summary = self.generate_respondents_summary()
+        link = '/view_{}'.format(self.key.id())
+        return u'{} {}.\n{}'.format(short_bold_title, respondents_summary, link)
 
-class Poll(ndb.Model):
+    def render_html_details(self, user):
+        user_description = user.get_description() if user else 'unknown ({})'.format(self.admin_uid)
+        user_description = util.strip_html_symbols(user_description)
+        timestamp = (self.created + timedelta(hours=8)).strftime('%a, %d %b \'%y, %H:%M:%S')
+        return u' <small>by {} on {}</small>'.format(user_description, timestamp)
+
+    def render_html_summary(self, creators):
+        title = util.make_html_bold(self.title_short)
+        details = self.render_html_details(creators.get(self.admin_uid))
+        link = '<a href="/poll/{}">View</a>'.format(self.key.id())
+        return u'<p>{}{} {}</p>'.format(title, details, link)
+
+class Poll(ndb.Model, PollListing):
     admin_uid = ndb.StringProperty()
     title = ndb.TextProperty()
     title_short = ndb.StringProperty()
@@ -57,118 +135,884 @@ class Poll(ndb.Model):
     multi = ndb.BooleanProperty(default=True, indexed=False)
 
     options = ToJsonProperty(repeated=True)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # kept up to date as votes are applied; None on polls last written before it existed
+    num_respondents = ndb.IntegerProperty(indexed=False)
+    # options and respondents of an archived poll, as compressed JSON
+    archived_options = ndb.BlobProperty()
+    # whether every respondent has a Ballot; polls from before ballots get them from MigratePage
+    ballots_complete = ndb.BooleanProperty(default=False, indexed=False)
 
     created = ndb.DateTimeProperty(auto_now_add=True)
     updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
+    pending_votes = 0
+    restored = False
+
+    ARCHIVE_AFTER_DAYS = 90
+    MAX_ARCHIVE_BYTES = 900 * 1024
+
+    # Telegram rejects longer messages; the margin covers the link and the "+N more" lines
+    MAX_TEXT_LENGTH = 4096
+    TEXT_MARGIN = 300
+    # first names are never empty, so a message shows fewer names than this
+    TEXT_POSITIONS = MAX_TEXT_LENGTH // 2
+    WEB_PAGE_SIZE = 500
+    WEB_URL = 'https://countmeinbot.appspot.com/view/{}?sig={}'
+    FULL_LIST = u'<a href="{}">See everyone who responded</a>'
+
+    def _pre_put_hook(self):
+        self.version += 1
+        self.get_num_respondents()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        RENDER_CACHE.invalidate(key.id())
+        ndb.Key(PollSummary, key.id()).delete_async()
+        RespondentPage.delete_for_async(key)
+        Ballot.delete_for_async(key.id())
+
+    def get_version(self):
+        return '{}.{}'.format(self.version, self.pending_votes)
+
     @classmethod
     def new(cls, admin_uid, title):
         title_short = util.uslice(title, 0, 512).lower()
-        return cls(admin_uid=admin_uid, title=title, title_short=title_short)
+        return cls(admin_uid=admin_uid, title=title, title_short=title_short, num_respondents=0,
+                   ballots_complete=True)
+
+    def save(self):
+        return self.save_async().get_result()
+
+    @ndb.tasklet
+    def save_async(self):
+        # the summary is written alongside, so that listings never need the full poll
+        if not self.key:
+            yield self.put_async()
+            yield PollSummary.from_poll(self).put_async()
+            return
+
+        # options that outgrow the poll move their respondents out to pages, and only the pages
+        # that changed are written
+        pages = []
+        for i, option in enumerate(self.options):
+            if option.num_pages or len(option.encode()) > Option.PAGING_THRESHOLD:
+                pages += [RespondentPage(key=RespondentPage.key_for(self.key, i, page),
+                                         people=encoded_people)
+                          for page, encoded_people in option.build_pages().iteritems()]
+        yield ndb.put_multi_async([self, PollSummary.from_poll(self)] + pages)
+
+    def get_page_keys(self):
+        return [RespondentPage.key_for(self.key, i, page) for i, option in enumerate(self.options)
+                for page in range(option.num_pages)]
+
+    @staticmethod
+    def load_pages(polls, start=0, stop=None):
+        return Poll.load_pages_async(polls, start, stop).get_result()
+
+    @staticmethod
+    def load_pages_async(polls, start=0, stop=None):
+        # the pages holding respondents start to stop of each paged option, all of them by default
+        return Poll.attach_pages_async(polls, lambda option: option.get_page_numbers(start, stop))
+
+    @staticmethod
+    @ndb.tasklet
+    def attach_pages_async(polls, select):
+        # fetches the pages that select picks for each option and that are not attached yet, with
+        # one batch get for all the polls
+        wanted = []
+        for poll in polls:
+            for i, option in enumerate(poll.options if poll else []):
+                wanted += [(option, page, RespondentPage.key_for(poll.key, i, page))
+                           for page in select(option) if not option.has_page(page)]
+        if not wanted:
+            return
+        pages = yield ndb.get_multi_async([key for _, _, key in wanted], use_cache=False)
+        for (option, page, _), entity in zip(wanted, pages):
+            option.attach_page(page, entity.people if entity else '[]')
+
+    @classmethod
+    @ndb.tasklet
+    def read_live_async(cls, poll_id):
+        # the poll and its vote shards, restoring an archived poll; the context cache is bypassed
+        # so that a copy with votes applied is never handed out as the snapshot
+        keys = [ndb.Key(cls, poll_id)] + VoteShard.keys_for(poll_id)
+        entities = yield ndb.get_multi_async(keys, use_cache=False)
+        poll = entities[0]
+        if poll and not poll.active:
+            poll = (yield Poll.restore_async(poll_id)) or \
+                   (yield cls.get_by_id_async(poll_id, use_cache=False))
+        raise ndb.Return(poll, entities[1:])
+
+    @classmethod
+    def get_live(cls, poll_id, start=0, stop=TEXT_POSITIONS):
+        return cls.get_live_async(poll_id, start, stop).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_live_async(cls, poll_id, start=0, stop=TEXT_POSITIONS):
+        # only the pages holding respondents start to stop are read, by default those a message
+        # can show; the votes go in first, so that the pages cover the removals among them
+        poll, shards = yield cls.read_live_async(poll_id)
+        if poll:
+            if VoteShard.has_legacy_votes(shards):
+                yield Poll.load_pages_async([poll])
+            poll.apply_shards(shards)
+            yield Poll.load_pages_async([poll], start, stop)
+        raise ndb.Return(poll)
 
     @staticmethod
-    @ndb.transactional
     def toggle(poll_id, opt_id, uid, user_profile):
-        poll = Poll.get_by_id(poll_id)
+        return Poll.toggle_async(poll_id, opt_id, uid, user_profile).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def toggle_async(poll_id, opt_id, uid, user_profile, on_recorded=None):
+        metrics.incr('toggle.calls')
+        # one read of the poll and its shards serves to check the option, outside the vote
+        # transaction so that folds never conflict with it, and to render the result
+        poll, shards = yield Poll.read_live_async(poll_id)
         if not poll:
-            return None, 'Sorry, this poll has been deleted'
+            raise ndb.Return(None, 'Sorry, this poll has been deleted')
         if opt_id >= len(poll.options):
-            return None, 'Sorry, that\'s an invalid option'
-        status = poll.options[opt_id].toggle(uid, user_profile)
+            if VoteShard.has_legacy_votes(shards):
+                yield Poll.load_pages_async([poll])
+            poll.apply_shards(shards)
+            yield Poll.load_pages_async([poll], stop=Poll.TEXT_POSITIONS)
+            raise ndb.Return(poll, 'Sorry, that\'s an invalid option')
+
+        # the pages a message shows are read while the vote is recorded
+        pages_future = Poll.load_pages_async([poll], stop=Poll.TEXT_POSITIONS)
+        with metrics.timer('toggle.append_vote'):
+            choices = [] if poll.ballots_complete else None
+            votes = yield Poll.append_vote_async(poll_id, opt_id, uid, user_profile, choices)
+            if votes is None:
+                # a voter with no ballot on a poll from before ballots; their choices are read
+                # off every page of the live poll
+                live_poll = yield Poll.get_live_async(poll_id, 0, None)
+                if not live_poll:
+                    raise ndb.Return(None, 'Sorry, this poll has been deleted')
+                votes = yield Poll.append_vote_async(poll_id, opt_id, uid, user_profile,
+                                                     live_poll.get_choices(uid))
+        if on_recorded:
+            on_recorded()
+        fold_future = Poll.schedule_fold_async(poll_id)
+        yield pages_future
+
+        # the voter's shard as read is replaced with the one just written, unless a fold
+        # emptied it in between and the poll has to be read again
+        shard_id = int(uid) % VoteShard.NUM_SHARDS
+        old_votes = shards[shard_id].votes if shards[shard_id] else []
+        if votes[:len(old_votes)] == old_votes:
+            shards[shard_id] = VoteShard(key=VoteShard.key_for(poll_id, uid), votes=votes)
+            if VoteShard.has_legacy_votes(shards):
+                yield Poll.load_pages_async([poll])
+            poll.apply_shards(shards)
+            yield Poll.load_pages_async([poll], stop=Poll.TEXT_POSITIONS)
+        else:
+            restored = poll.restored
+            poll = yield Poll.get_live_async(poll_id)
+            if not poll:
+                raise ndb.Return(None, 'Sorry, this poll has been deleted')
+            poll.restored = restored
+        yield fold_future
+
+        action = u'added to' if votes[-1][4] else u'removed from'
+        raise ndb.Return(poll, u'Your name was {} {}!'.format(action, poll.options[opt_id].title))
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def append_vote_async(poll_id, opt_id, uid, user_profile, choices=None):
+        # only this voter's shard and ballot are read and written, so concurrent voters on other
+        # shards and folds of the poll do not collide with it; each vote records whether it
+        # added the voter and how it changed the number of respondents, so that applying it
+        # needs none of the respondents. Returns the shard's votes, or None when the voter has
+        # no ballot and choices to start one from were not given
+        metrics.incr('toggle.attempts')
+        shard_key = VoteShard.key_for(poll_id, uid)
+        shard, ballot = yield ndb.get_multi_async([shard_key, Ballot.key_for(poll_id, uid)])
+        if not ballot:
+            if choices is None:
+                raise ndb.Return(None)
+            ballot = Ballot(key=Ballot.key_for(poll_id, uid), opt_ids=choices)
+        responded = bool(ballot.opt_ids)
+        added = opt_id not in ballot.opt_ids
+        if added:
+            ballot.opt_ids.append(opt_id)
+        else:
+            ballot.opt_ids.remove(opt_id)
+        shard = shard or VoteShard(key=shard_key, votes=[])
+        shard.votes.append([opt_id, str(uid), user_profile['first_name'],
+                            user_profile['last_name'], added, bool(ballot.opt_ids) - responded])
+        yield ndb.put_multi_async([shard, ballot])
+        raise ndb.Return(shard.votes)
+
+    @staticmethod
+    @ndb.tasklet
+    def schedule_fold_async(poll_id):
+        interval = VoteShard.FOLD_INTERVAL
+        slot = int(time.time() / interval)
+        name = 'fold-{}-{}'.format(poll_id, slot)
+        added = yield ndb.get_context().memcache_add(name, 1, time=interval * 2)
+        if not added:
+            return
+        task = taskqueue.Task(url='/tasks/fold', name=name, params={'poll_id': poll_id},
+                              countdown=interval)
+        try:
+            yield taskqueue.Queue('fold').add_async(task)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def fold(poll_id):
+        # all shards in one transaction, so the poll, its summary and its pages are written once;
+        # that is 12 entity groups, within the limit of 25
+        entities = ndb.get_multi([ndb.Key(Poll, poll_id)] + VoteShard.keys_for(poll_id))
+        poll, shards = entities[0], [shard for shard in entities[1:] if shard]
+        if not shards:
+            return
+        if poll:
+            # only the pages that the votes rewrite are read
+            if VoteShard.has_legacy_votes(shards):
+                Poll.load_pages([poll])
+            poll.apply_shards(shards)
+            Poll.attach_pages_async([poll], Option.get_pending_page_numbers).get_result()
+            poll.save()
+        ndb.delete_multi([shard.key for shard in shards])
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def archive(poll_id):
+        # packs an idle poll's options into one compressed blob and drops it from the summaries
+        # that the hot queries read; polls with unfolded votes or too many respondents stay hot
+        poll = Poll.get_by_id(poll_id)
+        if not poll or not poll.active or any(ndb.get_multi(VoteShard.keys_for(poll_id))):
+            return None
+        Poll.load_pages([poll])
+        packed = []
+        for option in poll.options:
+            flat_people = []
+            for uid, (first_name, last_name) in option.iter_people():
+                flat_people.extend((uid, first_name, last_name))
+            packed.append([option.title, flat_people])
+        archived_options = zlib.compress(json.dumps(packed), 9)
+        if len(archived_options) > Poll.MAX_ARCHIVE_BYTES:
+            return None
+
+        stale_keys = poll.get_page_keys() + [ndb.Key(PollSummary, poll_id)]
+        poll.get_num_respondents()
+        poll.archived_options = archived_options
+        poll.options = []
+        poll.active = False
         poll.put()
-        return poll, status
+        ndb.delete_multi(stale_keys)
+        return poll
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def restore_async(poll_id):
+        poll = yield Poll.get_by_id_async(poll_id)
+        if not poll or poll.active:
+            raise ndb.Return(None)
+        poll.unpack_archive()
+        poll.active = True
+        poll.archived_options = None
+        yield poll.save_async()
+        poll.restored = True
+        raise ndb.Return(poll)
+
+    def unpack_archive(self):
+        # fills in the options of an archived poll without restoring it
+        self.options = []
+        for title, flat_people in json.loads(zlib.decompress(self.archived_options)):
+            people = OrderedDict((flat_people[i], (flat_people[i + 1], flat_people[i + 2]))
+                                 for i in range(0, len(flat_people), 3))
+            self.options.append(Option(title, people))
+
+    def apply_shards(self, shards):
+        for shard in shards:
+            if shard:
+                self.apply_votes(shard.votes)
+        # each shard only grows until a fold bumps the version, so their lengths tell renders
+        # apart, including those of a vote applied to an earlier snapshot
+        if any(shards):
+            self.pending_votes = '-'.join(str(len(shard.votes) if shard else 0)
+                                          for shard in shards)
+
+    def apply_votes(self, votes):
+        num_respondents = self.get_num_respondents()
+        for vote in votes:
+            opt_id, uid, first_name, last_name = vote[:4]
+            if opt_id >= len(self.options):
+                continue
+            option = self.options[opt_id]
+            if len(vote) > 4:
+                added, change = vote[4:]
+                if added:
+                    option.add(uid, (first_name, last_name))
+                else:
+                    option.remove(uid)
+            else:
+                # votes from before ballots say neither, so they need every respondent
+                responded = self.has_responded(uid)
+                option.toggle(uid, {'first_name': first_name, 'last_name': last_name})
+                change = self.has_responded(uid) - responded
+            num_respondents += change
+        self.num_respondents = num_respondents
+
+    def has_responded(self, uid):
+        return any(option.contains(uid) for option in self.options)
+
+    def get_choices(self, uid):
+        return [i for i, option in enumerate(self.options) if option.contains(uid)]
+
+    @staticmethod
+    @ndb.tasklet
+    def complete_ballots_async(poll_id):
+        # gives every respondent of a poll from before ballots their ballot, so that their
+        # votes no longer read every page; a poll with votes waiting for a fold is left for the
+        # next run. Returns whether the poll now has all its ballots
+        keys = [ndb.Key(Poll, poll_id)] + VoteShard.keys_for(poll_id)
+        entities = yield ndb.get_multi_async(keys, use_cache=False)
+        poll = entities[0]
+        if not poll or poll.ballots_complete or any(entities[1:]):
+            raise ndb.Return(False)
+        if poll.active:
+            yield Poll.load_pages_async([poll])
+        else:
+            poll.unpack_archive()
+
+        choices = OrderedDict()
+        for i, option in enumerate(poll.options):
+            for uid, _ in option.iter_people():
+                choices.setdefault(uid, []).append(i)
+        groups = OrderedDict()
+        for uid, opt_ids in choices.iteritems():
+            groups.setdefault(VoteShard.key_for(poll_id, uid), []).append(
+                (Ballot.key_for(poll_id, uid), opt_ids))
+        futures = [Ballot.insert_missing_async(group[i:i + Ballot.BATCH_SIZE])
+                   for group in groups.values() for i in range(0, len(group), Ballot.BATCH_SIZE)]
+        yield futures
+        yield Poll.mark_ballots_complete_async(poll_id)
+        raise ndb.Return(True)
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def mark_ballots_complete_async(poll_id):
+        poll = yield Poll.get_by_id_async(poll_id)
+        if poll:
+            poll.ballots_complete = True
+            yield poll.put_async()
+
+    def get_num_respondents(self):
+        if self.num_respondents is None:
+            all_uids = util.flatten([option.people.keys() for option in self.options])
+            self.num_respondents = len(set(all_uids))
+        return self.num_respondents
 
     def get_friendly_id(self):
         return util.uslice(self.title, 0, 512)
 
+    def has_legacy_options(self):
+        return any(option.legacy for option in self.options)
+
     def generate_options_summary(self):
         return u' / '.join([option.title for option in self.options])
 
-    def generate_respondents_summary(self):
-        all_uids_by_option = [option.people.keys() for option in self.options]
-        all_uids = util.flatten(all_uids_by_option)
-        num_respondents = len(set(all_uids))
-        if num_respondents == 0:
-            output = 'Nobody responded'
-        elif num_respondents == 1:
-            output = '1 person responded'
-        else:
-            output = '{} people responded'.format(num_respondents)
-        return output
+    @cache.memoize_render(RENDER_CACHE)
+    def render_text(self):
+        # names are shown until the message would get too long, so the cost of rendering does
+        # not grow with the number of respondents
+        header = [util.make_html_bold_first_line(self.title)]
+        footer = [util.emoji_people_unicode() + ' ' + self.generate_respondents_summary()]
+        fixed_text = u'\n\n'.join(header + footer + [option.render_title() + '\n'
+                                                      for option in self.options])
+        budget = self.MAX_TEXT_LENGTH - self.TEXT_MARGIN - util.utf16_len(fixed_text)
 
-    def generate_poll_summary_with_link(self):
-        short_bold_title = util.make_html_bold(util.uslice(self.title, 0, 65))
-        respondents_summary = self.generate_respondents_summary()
-        link = '/view_{}'.format(self.key.id())
-        return u'{} {}.\n{}'.format(short_bold_title, respondents_summary, link)
+        body = []
+        truncated = False
+        for i, option in enumerate(self.options):
+            names, hidden = option.get_names(max(budget, 0) // (len(self.options) - i))
+            budget -= sum(util.utf16_len(name) + 1 for name in names)
+            truncated = truncated or hidden
+            body.append(option.render_names(names, hidden))
+        if truncated:
+            footer.insert(0, self.FULL_LIST.format(self.get_web_url()))
+        return u'\n\n'.join(header + body + footer)
 
-    def render_text(self):
+    def render_text_page(self, page):
+        # the full name lists for the web view, WEB_PAGE_SIZE names per option on each page; not
+        # memoized, since pages of a large poll would push the render cache record past the
+        # memcache value limit, and the bounded page size keeps rendering one cheap
+        start = page * self.WEB_PAGE_SIZE
+        body = []
+        for option in self.options:
+            people = islice(option.iter_people(start), self.WEB_PAGE_SIZE)
+            names = [util.strip_html_symbols(first_name) for _, (first_name, _) in people]
+            body.append(option.render_names(names, max(option.count - start - len(names), 0)))
         header = [util.make_html_bold_first_line(self.title)]
-        body = [option.render_text() for option in self.options]
         footer = [util.emoji_people_unicode() + ' ' + self.generate_respondents_summary()]
         return u'\n\n'.join(header + body + footer)
 
-    def render_html(self):
-        from datetime import timedelta
+    def get_num_pages(self):
+        max_count = max([option.count for option in self.options] + [1])
+        return (max_count - 1) // self.WEB_PAGE_SIZE + 1
 
-        user = User.get_by_id(int(self.admin_uid))
-        user_description = user.get_description() if user else 'unknown ({})'.format(self.admin_uid)
-        timestamp = (self.created + timedelta(hours=8)).strftime('%a, %d %b \'%y, %H:%M:%S')
-        details = u' <small>by {} on {}</small>'.format(user_description, timestamp)
+    @staticmethod
+    def sign(poll_id):
+        return hmac.new(BOT_TOKEN, str(poll_id), hashlib.sha256).hexdigest()[:16]
+
+    def get_web_url(self):
+        return self.WEB_URL.format(self.key.id(), self.sign(self.key.id()))
 
-        text = self.render_text()
+    def render_html(self, creators=None, page=0):
+        # creators maps admin_uid to a prefetched User, to avoid one lookup per poll
+        if creators is None:
+            creators = {self.admin_uid: User.get_by_id(int(self.admin_uid))}
+        details = self.render_html_details(creators.get(self.admin_uid))
+
+        text = self.render_text_page(page)
         idx = text.find('\n')
         text = (text[:idx] + details + text[idx:])
 
         return '<p>' + text.replace('\n', '<br>\n') + '</p>'
 
+    def render_public_html(self, page=0):
+        # the signed web view, which anyone with a message of the poll can open, so it says nothing
+        # about the creator
+        return '<p>' + self.render_text_page(page).replace('\n', '<br>\n') + '</p>'
+
+    @staticmethod
+    def get_creators(polls):
+        admin_uids = list(set(poll.admin_uid for poll in polls))
+        users = ndb.get_multi([ndb.Key(User, int(admin_uid)) for admin_uid in admin_uids])
+        return dict(zip(admin_uids, users))
+
+    # keyboards are built as the dicts the Bot API expects, without the telegram package
+    @cache.memoize_render(RENDER_CACHE)
     def build_vote_buttons(self, admin=False):
         poll_id = self.key.id()
         buttons = []
         for i, option in enumerate(self.options):
             data = '{} {}'.format(poll_id, i)
-            button = InlineKeyboardButton(option.title, callback_data=data)
+            button = {'text': option.title, 'callback_data': data}
             buttons.append([button])
         if admin:
             back_data = '{} back'.format(poll_id)
-            back_button = InlineKeyboardButton('Back', callback_data=back_data)
+            back_button = {'text': 'Back', 'callback_data': back_data}
             buttons.append([back_button])
-        return InlineKeyboardMarkup(buttons).to_dict()
+        return {'inline_keyboard': buttons}
 
+    @cache.memoize_render(RENDER_CACHE)
     def build_admin_buttons(self):
         poll_id = self.key.id()
-        insert_key = self.get_friendly_id().encode('utf-8')
-        publish_button = InlineKeyboardButton('Publish poll', switch_inline_query=insert_key)
+        insert_key = self.get_friendly_id()
+        publish_button = {'text': 'Publish poll', 'switch_inline_query': insert_key}
         refresh_data = '{} refresh'.format(poll_id)
-        refresh_button = InlineKeyboardButton('Update results', callback_data=refresh_data)
+        refresh_button = {'text': 'Update results', 'callback_data': refresh_data}
         vote_data = '{} vote'.format(poll_id)
-        vote_button = InlineKeyboardButton('Vote', callback_data=vote_data)
+        vote_button = {'text': 'Vote', 'callback_data': vote_data}
         delete_data = '{} delete'.format(poll_id)
-        delete_button = InlineKeyboardButton('Delete', callback_data=delete_data)
+        delete_button = {'text': 'Delete', 'callback_data': delete_data}
         buttons = [[publish_button], [refresh_button], [vote_button, delete_button]]
-        return InlineKeyboardMarkup(buttons).to_dict()
+        return {'inline_keyboard': buttons}
+
+class Draft(ndb.Model):
+    # a poll under construction, keyed by the creator's chat id; memcache serves it, and the
+    # datastore copy keeps it when memcache evicts it
+    TTL = 3600
+
+    title = ndb.TextProperty()
+    options = ndb.JsonProperty()
+
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @staticmethod
+    def get_cache_key(uid):
+        return 'draft:{}'.format(uid)
+
+    @classmethod
+    @ndb.tasklet
+    def load_async(cls, uid):
+        record = yield ndb.get_context().memcache_get(cls.get_cache_key(uid))
+        if record:
+            raise ndb.Return(cls(id=uid, title=record['title'], options=record['options']))
+        draft = yield cls.get_by_id_async(uid)
+        if draft and draft.updated < datetime.now() - timedelta(seconds=cls.TTL):
+            draft = None
+        raise ndb.Return(draft)
+
+    def save_async(self):
+        # the put is not waited on, since handlers run under ndb.toplevel; it also replaces any
+        # stale copy, so /start leaves no older draft to come back after an eviction
+        record = {'title': self.title, 'options': self.options}
+        self.put_async()
+        return ndb.get_context().memcache_set(self.get_cache_key(self.key.id()), record,
+                                              time=self.TTL)
+
+    @ndb.tasklet
+    def commit_async(self):
+        poll = Poll.new(admin_uid=self.key.id(), title=self.title)
+        poll.options = [Option(title) for title in self.options]
+        cache_key = self.get_cache_key(self.key.id())
+        yield (poll.save_async(), ndb.get_context().memcache_delete(cache_key),
+               self.key.delete_async())
+        raise ndb.Return(poll)
+
+class PollSummary(ndb.Model, PollListing):
+    # what poll listings show, keyed by the poll id and written with every save of the poll
+    MAX_WORDS = 50
+    MAX_PREFIX = 10
+    MAX_WORDS_BYTES = 1500
+
+    admin_uid = ndb.StringProperty()
+    title = ndb.TextProperty()
+    title_short = ndb.StringProperty(indexed=False)
+    options_summary = ndb.TextProperty()
+    num_respondents = ndb.IntegerProperty(indexed=False)
+    # the words in the title and options, space separated and indexed so that inline search can
+    # read them with a projection, and their prefixes to query by
+    words = ndb.StringProperty()
+    search_tokens = ndb.StringProperty(repeated=True)
+
+    created = ndb.DateTimeProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def from_poll(cls, poll):
+        summary = cls(id=poll.key.id(), admin_uid=poll.admin_uid, title=poll.get_friendly_id(),
+                      title_short=poll.title_short,
+                      options_summary=poll.generate_options_summary(),
+                      num_respondents=poll.get_num_respondents(), created=poll.created)
+        words = util.tokenize(poll.title_short + u' ' + summary.options_summary, cls.MAX_WORDS)
+        summary.words = cls.join_words(words)
+        summary.search_tokens = sorted(set(word[:length] for word in summary.get_words()
+                                           for length in range(1, cls.MAX_PREFIX + 1)))
+        return summary
+
+    @classmethod
+    def join_words(cls, words):
+        # as many words as fit in an indexed string
+        joined = u''
+        for word in words:
+            candidate = joined + u' ' + word if joined else word
+            if len(candidate.encode('utf-8')) > cls.MAX_WORDS_BYTES:
+                break
+            joined = candidate
+        return joined
+
+    def get_num_respondents(self):
+        return self.num_respondents
+
+    def get_words(self):
+        return (self.words or u'').split()
+
+    @staticmethod
+    def matches(words, tokens):
+        return all(any(word.startswith(token) for word in words) for token in tokens)
+
+class RespondentPage(ndb.Model):
+    # one page of respondents of a paged option, as a child of the poll so that a fold can write
+    # it in the same transaction; people is the same flat list an option keeps inline
+    people = ndb.TextProperty()
+
+    @classmethod
+    def key_for(cls, poll_key, opt_id, page):
+        return ndb.Key(cls, '{}-{}'.format(opt_id, page), parent=poll_key)
+
+    @classmethod
+    @ndb.tasklet
+    def delete_for_async(cls, poll_key):
+        keys = yield cls.query(ancestor=poll_key).fetch_async(keys_only=True)
+        yield ndb.delete_multi_async(keys)
+
+class VoteShard(ndb.Model):
+    NUM_SHARDS = 10
+    FOLD_INTERVAL = 5
+
+    votes = ndb.JsonProperty()
+
+    @classmethod
+    def key_for(cls, poll_id, uid):
+        return ndb.Key(cls, '{}-{}'.format(poll_id, int(uid) % cls.NUM_SHARDS))
+
+    @classmethod
+    def keys_for(cls, poll_id):
+        return [ndb.Key(cls, '{}-{}'.format(poll_id, i)) for i in range(cls.NUM_SHARDS)]
+
+    @staticmethod
+    def has_legacy_votes(shards):
+        # votes appended before ballots lack the added flag and the change in respondents
+        return any(len(vote) == 4 for shard in shards if shard for vote in shard.votes)
+
+class Ballot(ndb.Model):
+    # the options a voter has chosen in a poll, in the same entity group as their vote shard so
+    # that a vote can tell whether it adds or removes them without reading the poll's pages
+    BATCH_SIZE = 100
+
+    opt_ids = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, poll_id, uid):
+        return ndb.Key(cls, str(uid), parent=VoteShard.key_for(poll_id, uid))
+
+    @classmethod
+    @ndb.tasklet
+    def delete_for_async(cls, poll_id):
+        key_lists = yield [cls.query(ancestor=shard_key).fetch_async(keys_only=True)
+                           for shard_key in VoteShard.keys_for(poll_id)]
+        yield ndb.delete_multi_async(util.flatten(key_lists))
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def insert_missing_async(keys_and_choices):
+        # a ballot written by a vote since the choices were read is newer, so it is kept
+        ballots = yield ndb.get_multi_async([key for key, _ in keys_and_choices])
+        yield ndb.put_multi_async([Ballot(key=key, opt_ids=opt_ids) for (key, opt_ids), ballot
+                                   in zip(keys_and_choices, ballots) if not ballot])
 
 class Option(object):
-    def __init__(self, title, people=OrderedDict()):
+    # votes not yet folded into the stored respondents are kept aside in _added and _removed, so
+    # that applying them needs none of the respondents; a paged option holds only the pages that
+    # were attached to it
+    __slots__ = ('title', 'legacy', 'num_pages', 'page_counts', '_count', '_people',
+                 '_encoded_people', '_pages', '_added', '_removed')
+
+    MORE_NAMES = u'<i>+{} more</i>'
+    PAGING_THRESHOLD = 64 * 1024
+    PAGE_SIZE = 1000
+
+    def __init__(self, title, people=None):
         self.title = title
-        self.people = people
+        self.legacy = False
+        self.num_pages = 0
+        self.page_counts = None
+        self._count = None
+        self._people = OrderedDict() if people is None else people
+        self._encoded_people = None
+        self._pages = {}
+        self._added = OrderedDict()
+        self._removed = set()
 
-    def toggle(self, uid, user_profile):
+    @classmethod
+    def decode(cls, value):
+        header, _, encoded_people = value.partition('\n')
+        header = json.loads(header)
+        option = cls(header[0])
+        option._count = header[1]
+        # paged options keep their respondents in RespondentPage entities instead; the first
+        # of them were written without their page counts
+        option.num_pages = header[2] if len(header) > 2 else 0
+        option.page_counts = header[3] if len(header) > 3 else None
+        option._people = None
+        option._encoded_people = encoded_people
+        return option
+
+    def encode(self):
+        if self.num_pages:
+            header = [self.title, self.count, self.num_pages, self.page_counts]
+            return json.dumps(header) + '\n[]'
+        if self._added or self._removed:
+            self._people = OrderedDict(self.iter_people())
+            self._count = None
+            self._added, self._removed = OrderedDict(), set()
+        if self._people is None:
+            encoded_people = self._encoded_people
+        else:
+            encoded_people = self.encode_people(self._people.iteritems())
+        return json.dumps([self.title, self.count]) + '\n' + encoded_people
+
+    @staticmethod
+    def encode_people(people):
+        flat_people = []
+        for uid, (first_name, last_name) in people:
+            flat_people.extend((uid, first_name, last_name))
+        return json.dumps(flat_people)
+
+    @property
+    def people(self):
+        # a copy of every respondent, which needs all pages of a paged option
+        if self.num_pages and len(self._pages) < self.num_pages:
+            raise ValueError('Respondent pages of {!r} are not loaded'.format(self.title))
+        return OrderedDict(self.iter_people())
+
+    def has_page(self, page):
+        return page in self._pages
+
+    def attach_page(self, page, encoded_people):
+        self._pages[page] = encoded_people
+
+    def get_page(self, page):
+        if page not in self._pages:
+            raise ValueError('Respondent page {} of {!r} is not loaded'.format(page, self.title))
+        return self._pages[page]
+
+    def get_page_numbers(self, start=0, stop=None):
+        # the pages holding respondents start to stop; unfolded removals can move later
+        # respondents forward, so as many more are covered
+        if self.page_counts is None:
+            return range(self.num_pages)
+        if stop is not None:
+            stop += len(self._removed)
+        numbers = []
+        offset = 0
+        for page, page_count in enumerate(self.page_counts):
+            if offset + page_count > start and (stop is None or offset < stop):
+                numbers.append(page)
+            offset += page_count
+        return numbers
+
+    def get_pending_page_numbers(self):
+        # the pages that build_pages rewrites: the last page for added respondents, and all of
+        # them for removed ones, whose pages are not known
+        if not self.num_pages or not (self._added or self._removed):
+            return []
+        if self._removed or self.page_counts is None:
+            return range(self.num_pages)
+        return [self.num_pages - 1]
+
+    def build_pages(self):
+        # moves the respondents out to pages and returns the encoded pages that changed, by page
+        # number; respondents stay on the page they were added to and newcomers fill up the last
+        # page, so a vote that adds a name rewrites one page
+        if self.num_pages and not (self._added or self._removed):
+            return {}
+        changed = set()
+        pages = {}
+        if not self.num_pages:
+            page_counts, added = [], list(self.iter_people())
+        elif self._removed or self.page_counts is None:
+            page_counts, added = [], self._added.items()
+            for page in range(self.num_pages):
+                people = list(self.iter_encoded_people(self.get_page(page)))
+                pages[page] = [person for person in people if person[0] not in self._removed]
+                page_counts.append(len(pages[page]))
+                if len(pages[page]) < len(people):
+                    changed.add(page)
+        else:
+            page_counts, added = list(self.page_counts), self._added.items()
+
+        for uid, name in added:
+            if not page_counts or page_counts[-1] >= self.PAGE_SIZE:
+                page_counts.append(0)
+                pages[len(page_counts) - 1] = []
+            last = len(page_counts) - 1
+            if last not in pages:
+                pages[last] = list(self.iter_encoded_people(self.get_page(last)))
+            pages[last].append((uid, name))
+            page_counts[last] += 1
+            changed.add(last)
+        if not page_counts:
+            page_counts, pages[0] = [0], []
+            changed.add(0)
+
+        encoded_pages = dict((page, self.encode_people(pages[page])) for page in changed)
+        self._pages.update(encoded_pages)
+        self.num_pages = len(page_counts)
+        self.page_counts = page_counts
+        self._count = sum(page_counts)
+        self._people, self._encoded_people = None, None
+        self._added, self._removed = OrderedDict(), set()
+        return encoded_pages
+
+    @property
+    def count(self):
+        count = len(self._people) if self._count is None else self._count
+        return count + len(self._added) - len(self._removed)
+
+    def __getstate__(self):
+        return {'title': self.title, 'people': self.people}
+
+    def __setstate__(self, state):
+        # also restores legacy pickles of the pre-__slots__ Option
+        self.__init__(state['title'], OrderedDict(state['people']))
+
+    def add(self, uid, name):
+        self._added[str(uid)] = name
+
+    def remove(self, uid):
+        # a respondent added and removed again was never stored, so there is nothing to drop
+        uid = str(uid)
+        if self._added.pop(uid, None) is None:
+            self._removed.add(uid)
+
+    def contains(self, uid):
+        # needs every respondent; votes carry whether they added the voter, so only entries from
+        # before ballots and the ballot backfill call this
         uid = str(uid)
-        if self.people.get(uid):
-            self.people.pop(uid, None)
+        if uid in self._added or uid in self._removed:
+            return uid in self._added
+        if not self.num_pages:
+            if self._people is None:
+                self._people = OrderedDict(self.iter_people())
+                self._count, self._encoded_people = None, None
+            return uid in self._people
+        return uid in self.people
+
+    def toggle(self, uid, user_profile):
+        if self.contains(uid):
+            self.remove(uid)
             action = u'removed from'
         else:
-            self.people[uid] = user_profile['first_name'], user_profile['last_name']
+            self.add(uid, (user_profile['first_name'], user_profile['last_name']))
             action = u'added to'
         return u'Your name was {} {}!'.format(action, self.title)
 
-    def render_text(self):
+    def iter_people(self, start=0):
+        # respondents from position start on, decoded only as far as they are read; a paged
+        # option yields only as far as its pages are loaded, and whole pages are skipped by
+        # their stored counts, so unfolded removals from them can shift positions a little
+        skipped = 0
+        complete = True
+        if not self.num_pages:
+            if self._people is None:
+                stored = self.iter_encoded_people(self._encoded_people)
+            else:
+                stored = self._people.iteritems()
+        else:
+            encoded_pages = []
+            for page in range(self.num_pages):
+                page_count = self.page_counts[page] if self.page_counts else None
+                if not encoded_pages and page_count is not None and skipped + page_count <= start:
+                    skipped += page_count
+                    continue
+                if page not in self._pages:
+                    complete = False
+                    break
+                encoded_pages.append(self._pages[page])
+            stored = chain.from_iterable(self.iter_encoded_people(encoded_people)
+                                         for encoded_people in encoded_pages)
+        people = ((uid, name) for uid, name in stored if uid not in self._removed)
+        if complete:
+            people = chain(people, self._added.iteritems())
+        return islice(people, start - skipped, None)
+
+    @staticmethod
+    def iter_encoded_people(encoded_people):
+        values = util.iter_json_array(encoded_people)
+        return ((uid, (first_name, last_name)) for uid, first_name, last_name
+                in izip(values, values, values))
+
+    def get_names(self, budget=None):
+        # escaped first names that fit in budget UTF-16 units, and how many did not
+        names = []
+        for _, (first_name, _) in self.iter_people():
+            name = util.strip_html_symbols(first_name)
+            if budget is not None:
+                budget -= util.utf16_len(name) + 1
+                if budget < 0:
+                    break
+            names.append(name)
+        return names, self.count - len(names)
+
+    def render_title(self):
         title = util.make_html_bold(self.title)
-        if self.people:
-            title += u' ({}{})'.format(len(self.people), util.emoji_people_unicode())
-        name_list = util.strip_html_symbols(self.generate_name_list())
-        return title + '\n' + name_list
+        if self.count:
+            title += u' ({}{})'.format(self.count, util.emoji_people_unicode())
+        return title
 
-    def generate_name_list(self):
-        return '\n'.join([first_name for first_name, _ in self.people.values()])
+    def render_names(self, names, hidden=0):
+        if hidden:
+            names = names + [self.MORE_NAMES.format(hidden)]
+        return self.render_title() + '\n' + '\n'.join(names)
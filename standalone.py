@@ -0,0 +1,145 @@
+"""Offline dev runner: serves the bot on the SDK's API stubs, without App Engine or Telegram
+
+Usage: GAE_SDK=/path/to/google_appengine python standalone.py [options]
+
+  --host HOST         interface to listen on (default 127.0.0.1); admin pages are not protected
+  --port N            port of the WSGI server (default 8080)
+  --datastore FILE    SQLite file holding the datastore (default standalone.sqlite)
+  --workers N         threads running queued tasks (default 8)
+  --telegram-stub N   answer Bot API calls from a stub server on port N instead of Telegram
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, make_server
+
+from benchmarks.common import ROOT, setup_sdk
+
+POLL_INTERVAL = 0.1
+RETRY_COUNTDOWN = 5
+MAX_RETRIES = 5
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+def activate_stubs(datastore_path):
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(datastore_file=datastore_path, use_sqlite=True, save_changes=True)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_urlfetch_stub()
+    return bed
+
+def get_queue_names():
+    with open(os.path.join(ROOT, 'queue.yaml')) as queue_yaml:
+        return ['default'] + re.findall(r'^- name: (\S+)', queue_yaml.read(), re.MULTILINE)
+
+class TaskRunner(object):
+    # runs queued tasks against the app on a thread pool, in place of App Engine's push queues
+    def __init__(self, app, workers):
+        from google.appengine.api import apiproxy_stub_map
+
+        self.app = app
+        self.pool = ThreadPool(workers)
+        self.stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        self.queue_names = get_queue_names()
+
+    def run_forever(self):
+        while True:
+            now_usec = time.time() * 1e6
+            for queue_name in self.queue_names:
+                for task in self.stub.GetTasks(queue_name):
+                    if task.get('eta_usec', 0) <= now_usec:
+                        self.stub.DeleteTask(queue_name, task['name'])
+                        self.pool.apply_async(self.run_task, (queue_name, task))
+            time.sleep(POLL_INTERVAL)
+
+    def run_task(self, queue_name, task):
+        import webapp2
+        from google.appengine.api import taskqueue
+
+        headers = dict(task['headers'])
+        retry_count = int(headers.get('X-AppEngine-TaskRetryCount', 0))
+        headers.update({'X-AppEngine-QueueName': queue_name,
+                        'X-AppEngine-TaskRetryCount': str(retry_count)})
+        body = base64.b64decode(task['body'])
+        request = webapp2.Request.blank(task['url'], headers=headers.items())
+        request.method = task['method']
+        request.body = body
+        try:
+            status = request.get_response(self.app).status_int
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Task {} failed'.format(task['url']))
+            status = 500
+        if status < 300:
+            return
+
+        if retry_count >= MAX_RETRIES:
+            logging.error('Dropping task {} after {} retries'.format(task['url'], retry_count))
+            return
+        headers['X-AppEngine-TaskRetryCount'] = str(retry_count + 1)
+        taskqueue.add(queue_name=queue_name, url=task['url'], method=task['method'],
+                      payload=body, headers=headers, countdown=RETRY_COUNTDOWN)
+
+def telegram_stub_app(environ, start_response):
+    # accepts every Bot API call and answers with a message, which is what the outbox expects
+    method_name = environ['PATH_INFO'].rsplit('/', 1)[-1]
+    params = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    logging.info('Bot API call {}: {}'.format(method_name, params))
+    result = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}}
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps({'ok': True, 'result': result})]
+
+def serve_in_background(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--datastore', default='standalone.sqlite')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--telegram-stub', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    setup_sdk('STANDALONE_TOKEN')
+    bed = activate_stubs(os.path.abspath(args.datastore))
+
+    if args.telegram_stub:
+        # read by TelegramPage when it creates its Bot, so it has to be set before that
+        os.environ['TELEGRAM_API_URL'] = 'http://127.0.0.1:{}/bot'.format(args.telegram_stub)
+        serve_in_background(make_server('127.0.0.1', args.telegram_stub, telegram_stub_app,
+                                        server_class=ThreadingWSGIServer))
+
+    from main import APP
+    from secrets import BOT_TOKEN
+
+    runner = TaskRunner(APP, args.workers)
+    thread = threading.Thread(target=runner.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    server = make_server(args.host, args.port, APP, server_class=ThreadingWSGIServer)
+    logging.info('Webhook at http://{}:{}/{}'.format(args.host, args.port, BOT_TOKEN))
+    try:
+        server.serve_forever()
+    finally:
+        bed.deactivate()
+
+if __name__ == '__main__':
+    main()
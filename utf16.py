@@ -0,0 +1,31 @@
+"""Surrogate-aware string slicing and length, consistent across narrow and wide Python builds"""
+
+import re
+
+_SURROGATE_PAIR = re.compile(u'[\ud800-\udbff][\udc00-\udfff]')
+_ILLEGAL_SURROGATE = re.compile(u'[\ud800-\udbff](?=[^\udc00-\udfff])')
+
+def skip_pairs(string, offset, scanned=0):
+    # Moves offset right by one code unit for each surrogate pair that starts between scanned and
+    # offset, mirroring a character-by-character scan. Pairs are counted with regex scans in C,
+    # each over only the newly covered stretch.
+    while offset > scanned:
+        pairs = len(_SURROGATE_PAIR.findall(string, scanned, offset + 1))
+        if not pairs:
+            break
+        scanned, offset = offset, offset + pairs
+    return offset
+
+def uslice(string, start, end):
+    # pairs before the start shift both offsets, pairs inside the slice only shift the end
+    start_units = skip_pairs(string, start)
+    end_units = skip_pairs(string, end + start_units - start, max(start_units, 0))
+    bound = max(start_units, end_units)
+    match = _ILLEGAL_SURROGATE.search(string, 0, bound + 1)
+    if match and match.start() < bound:
+        i = match.start()
+        raise ValueError("Illegal UTF-16 sequence: %r" % string[i:i + 2])
+    return string[start_units:end_units]
+
+def utf16_len(string):
+    return len(string.encode('utf-16-le')) // 2
@@ -1,33 +1,13 @@
 """Contains util functions"""
 
-def is_surrogate(string, i):
-    if 0xD800 <= ord(string[i]) <= 0xDBFF:
-        try:
-            char = string[i + 1]
-        except IndexError:
-            return False
-        if 0xDC00 <= ord(char) <= 0xDFFF:
-            return True
-        else:
-            raise ValueError("Illegal UTF-16 sequence: %r" % string[i:i + 2])
-    else:
-        return False
-
-def uslice(string, start, end):
-    length = len(string)
-    i = 0
-    while i < start and i < length:
-        if is_surrogate(string, i):
-            start += 1
-            end += 1
-            i += 1
-        i += 1
-    while i < end and i < length:
-        if is_surrogate(string, i):
-            end += 1
-            i += 1
-        i += 1
-    return string[start:end]
+import json
+import re
+
+from utf16 import uslice, utf16_len  # pylint: disable=unused-import
+
+_JSON_SCAN = json.JSONDecoder().scan_once
+_JSON_SPACE = re.compile(r'[ \t\n\r]*')
+_WORD = re.compile(r'\w+', re.UNICODE)
 
 def flatten(lst):
     return [item for sublist in lst for item in sublist]
@@ -45,6 +25,28 @@ def make_html_bold_first_line(text):
         output += '\n' + strip_html_symbols(text_split[1])
     return output
 
+def iter_json_array(text):
+    # decodes the items of a JSON array one at a time, so that a prefix is cheap to read
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    idx = _JSON_SPACE.match(text, text.index('[') + 1).end()
+    while text[idx] != ']':
+        value, idx = _JSON_SCAN(text, idx)
+        yield value
+        idx = _JSON_SPACE.match(text, idx).end()
+        if text[idx] == ',':
+            idx = _JSON_SPACE.match(text, idx + 1).end()
+
+def tokenize(text, limit=None):
+    # distinct lowercase words in order of first appearance
+    words = []
+    for word in _WORD.findall(text.lower()):
+        if word not in words:
+            words.append(word)
+            if len(words) == limit:
+                break
+    return words
+
 def emoji_people_unicode():
     # Emoji taken from http://unicode.org/emoji/charts/full-emoji-list.html
     return u'\U0001f465'
@@ -0,0 +1,66 @@
+"""Handlers for background tasks"""
+
+import logging
+
+from datetime import datetime, timedelta
+
+import backend
+import inline
+import metrics
+from main import MainPage
+from model import Poll, PollSummary, VoteShard
+
+import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb.query import Cursor
+
+class FoldPage(webapp2.RequestHandler):
+    def post(self):
+        poll_id = int(self.request.get('poll_id'))
+        if any(ndb.get_multi(VoteShard.keys_for(poll_id), use_cache=False)):
+            Poll.fold(poll_id)
+
+class UpdatePage(MainPage):
+    # handles the updates that the webhook queued instead of handling them itself
+    @metrics.flushed
+    @backend.batch_api_calls
+    @ndb.toplevel
+    def post(self):
+        logging.debug(self.request.body)
+        self.update = backend.parse_update(self.request.body)
+        with metrics.timer('worker.update'):
+            yield self.handle_update()
+
+class ArchivePage(webapp2.RequestHandler):
+    # run daily by cron; archives polls whose summary has not been written for a while
+    BATCH_SIZE = 100
+
+    def get(self):
+        try:
+            days = int(self.request.get('days'))
+        except ValueError:
+            days = Poll.ARCHIVE_AFTER_DAYS
+
+        try:
+            cursor = Cursor.from_websafe_string(self.request.get('cursor'))
+        except BadValueError:
+            cursor = None
+
+        cutoff = datetime.now() - timedelta(days=days)
+        query = PollSummary.query(PollSummary.updated < cutoff)
+        keys, next_cursor, has_more = query.fetch_page(self.BATCH_SIZE, start_cursor=cursor,
+                                                       keys_only=True)
+        archived = 0
+        for key in keys:
+            poll = Poll.archive(key.id())
+            if poll:
+                inline.remove_poll(poll)
+                archived += 1
+        logging.info('Archived {} of {} idle polls'.format(archived, len(keys)))
+        metrics.incr('archive.polls', archived)
+
+        if has_more:
+            params = {'days': days, 'cursor': next_cursor.to_websafe_string()}
+            taskqueue.add(url='/tasks/archive', method='GET', params=params)